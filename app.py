@@ -1,42 +1,371 @@
-from flask import Flask, render_template
-from store import aggregate_data, open_pull_requests
+import os
+import errno
+import fcntl
+import gzip
+import threading
+import time
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from cStringIO import StringIO
+from datetime import datetime
+from functools import wraps
+from hashlib import sha1
+from flask import Flask, Response, render_template, request, abort, url_for, escape, g, stream_with_context
+from werkzeug.http import is_resource_modified
+from store import KINDS, NoData, aggregate_data, data_version, snapshot_path, open_pull_requests, window_days, windowed_totals, windowed_user_stats, windowed_project_stats
+import omnijson as json
+import github
 from flaskext.markdown import Markdown
+from dictionaries import LRUDict
+import metrics
+import refresh
 import config
 
 app = Flask(__name__)
-Markdown(app)
+markdown = Markdown(app)
 app.config.from_object('config')
 
+# rendered pages: (view, view args, query args) -> [etag, body, gzipped body]
+pages = LRUDict(config.PAGE_CACHE_SIZE)
+_warmed = {'version': None}
+_warmed_lock = threading.Lock()
+
+# this worker's last save and its file in workers_metrics_path()
+_metrics_saved = {'at': 0, 'pid': None, 'name': None}
+_metrics_saved_lock = threading.Lock()
+
+REQUEST_SECONDS = metrics.Histogram('inquisition_request_seconds', 'Page response times', ['endpoint', 'status'])
+PAGE_CACHE = metrics.Counter('inquisition_page_cache_total', 'Page cache lookups', ['result'])
+SNAPSHOT_AGE = metrics.Gauge('inquisition_snapshot_age_seconds', 'Seconds since the served snapshot was published')
+SNAPSHOT_BYTES = metrics.Gauge('inquisition_snapshot_bytes', 'Size of the served snapshot')
+
+# smaller responses aren't worth gzipping
+GZIP_MIN_BYTES = 1024
+
+# open pull request bodies rendered to html: (id, updated_at) -> Markup
+bodies = LRUDict(config.BODY_CACHE_SIZE)
+_bodies_lock = threading.Lock()
+
+def rendered_body(pull):
+    """The html of the pull request's markdown body, rendered once per
+    update of the pull"""
+    key = (pull['id'], pull.get('updated_at'))
+    with _bodies_lock:     # the markdown instance isn't thread safe
+        body = bodies.get(key)
+        if body is None:
+            body = bodies[key] = markdown(escape(pull['body'] or ''))
+    return body
+
+def stream_template(template_name, **context):
+    """The template rendered a few rows at a time, to stream"""
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(5)
+    return stream
+
+def teed(chunks, key, etag):
+    """Passes the chunks of a streamed page on, caching the page once they
+    are all sent"""
+    sent = []
+    for chunk in chunks:
+        sent.append(chunk)
+        yield chunk
+    pages[key] = [etag, u''.join(sent), None]
+
+def data_etag():
+    return sha1(repr(data_version(config.ORGANISATION_NAME))).hexdigest()
+
+def compressed(body):
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=6) as f:
+        f.write(body)
+    return buf.getvalue()
+
+def no_query():
+    return ()
+
+def cached(mimetype='text/html', compress=False, query=no_query):
+    """Serves the view from the page cache while the data is unchanged, with
+    an ETag and Last-Modified from the data version, answering 304 when the
+    client already has it. With compress, bodies of GZIP_MIN_BYTES or more
+    are gzipped (once) for the clients that accept it. A view can return a
+    generator, to stream its page the first time it is rendered.
+
+    query checks the request args the view reads (aborting on bad ones) and
+    returns them normalised, to key the cache: other args and their order
+    don't make pages of their own."""
+    def decorator(view):
+        @wraps(view)
+        def cached_view(**view_args):
+            aggregate_data(config.ORGANISATION_NAME)    # maps the latest snapshot
+            query_args = query()
+            version = data_version(config.ORGANISATION_NAME)
+            etag = data_etag()
+            last_modified = datetime.utcfromtimestamp(max(file[0] for file in version if file))
+            if config.PAGE_CACHE_WARM:
+                warm_pages_once(version)
+            # the gzipped and plain bodies are different representations,
+            # each needs its own tag
+            gzip_accepted = compress and request.accept_encodings['gzip']
+            response_etag = etag + '-gzip' if gzip_accepted else etag
+
+            if not is_resource_modified(request.environ, etag=response_etag, last_modified=last_modified):
+                PAGE_CACHE.inc(result='not_modified')
+                response = Response(status=304)
+            else:
+                key = (view.__name__, tuple(sorted(view_args.items())), query_args)
+                page = pages.get(key)
+                PAGE_CACHE.inc(result='hit' if page and page[0] == etag else 'miss')
+                if not page or page[0] != etag:
+                    body = view(**view_args)
+                    if not isinstance(body, basestring):
+                        body = stream_with_context(teed(body, key, etag))
+                    page = [etag, body, None]
+                    if isinstance(body, basestring):
+                        pages[key] = page
+                body = page[1]
+                if not isinstance(body, basestring):
+                    response = Response(body, mimetype=mimetype)
+                elif gzip_accepted and len(body) >= GZIP_MIN_BYTES:
+                    if page[2] is None:
+                        page[2] = compressed(body.encode('utf-8') if isinstance(body, unicode) else body)
+                    response = Response(page[2], mimetype=mimetype)
+                    response.content_encoding = 'gzip'
+                else:
+                    response = Response(body, mimetype=mimetype)
+
+            if compress:
+                response.vary.add('Accept-Encoding')
+            response.set_etag(response_etag)
+            response.last_modified = last_modified
+            response.cache_control.no_cache = True      # revalidate every time
+            return response
+        return cached_view
+    return decorator
+
+def warm_pages():
+    """Renders the index, open pull requests, and the user and project pages
+    into the page cache, as many as it holds"""
+    data = aggregate_data(config.ORGANISATION_NAME)
+    with app.test_request_context():
+        urls = [url_for('index'), url_for('open_pulls'), url_for('api_open_pulls')]
+        urls += [url_for('api_leaderboard', kind=kind) for kind in KINDS]
+        urls += [url_for('project', projectname=name) for name in data['project_names']]
+        urls += [url_for('user', username=login) for login in data['users']]
+    # past its size the cache would evict the pages warmed first, the index
+    # and open pull requests among them
+    urls = urls[:pages.max_size]
+
+    for url in urls:
+        with app.test_request_context(url):
+            try:
+                # reads streamed pages through, into the cache
+                app.view_functions[request.endpoint](**request.view_args).get_data()
+            except Exception, e:
+                print '[warm_pages] %s failed: %s' % (url, e)
+    print '[warm_pages] rendered %d pages' % len(urls)
+
+def warm_pages_once(version):
+    with _warmed_lock:
+        if _warmed['version'] == version:
+            return
+        _warmed['version'] = version
+    background(warm_pages)
+
+def watch_data():
+    """Maps each new snapshot as it is published, and renders its pages,
+    ahead of the requests"""
+    while True:
+        try:
+            aggregate_data(config.ORGANISATION_NAME)
+            if config.PAGE_CACHE_WARM:
+                warm_pages_once(data_version(config.ORGANISATION_NAME))
+        except Exception, e:
+            print '[watch_data] failed: %s' % e
+        save_metrics()
+        time.sleep(config.SNAPSHOT_POLL_INTERVAL)
+
+def background(target, *args):
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+
+@app.before_request
+def start_timer():
+    g.started = time.time()
+
+@app.after_request
+def record_time(response):
+    if hasattr(g, 'started'):
+        REQUEST_SECONDS.observe(time.time() - g.started, endpoint=request.endpoint, status=response.status_code)
+    save_metrics()
+    return response
+
+def workers_metrics_path():
+    return '%s/%s.workers' % (config.STORE, config.ORGANISATION_NAME)
+
+def save_metrics(now=False):
+    """Saves this worker's metrics for /metrics, at most every
+    METRICS_SAVE_INTERVAL seconds unless now"""
+    with _metrics_saved_lock:
+        if _metrics_saved['pid'] != os.getpid():
+            # a new (forked) worker: named by pid and start, so one reusing
+            # a dead worker's pid doesn't overwrite its counts
+            _metrics_saved.update(at=0, pid=os.getpid(), name='%d-%d.json' % (os.getpid(), time.time() * 1000))
+        if not now and time.time() - _metrics_saved['at'] < config.METRICS_SAVE_INTERVAL:
+            return
+        _metrics_saved['at'] = time.time()
+        name = _metrics_saved['name']
+    directory = workers_metrics_path()
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass    # another worker made it
+    metrics.write_state(os.path.join(directory, name))
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+def retire_workers(directory):
+    """Folds the files of workers that have exited into retired.json: their
+    counters stay in the sum, their gauges go, and the files don't pile up"""
+    with open(os.path.join(directory, 'retired.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            dead = [name for name in os.listdir(directory) if name.endswith('.json') and name != 'retired.json'
+                and not alive(int(name.split('.')[0].split('-')[0]))]
+            if not dead:
+                return
+            retired = os.path.join(directory, 'retired.json')
+            states = [metrics.read_state(os.path.join(directory, name)) for name in ['retired.json'] + dead]
+            metrics.write_state(retired, metrics.cumulative(metrics.merge(states)))
+            for name in dead:
+                os.remove(os.path.join(directory, name))
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+@app.errorhandler(NoData)
+def no_data(e):
+    return Response('No data yet, waiting for refresh.py\n', status=503,
+        mimetype='text/plain', headers={'Retry-After': str(config.SNAPSHOT_POLL_INTERVAL or 60)})
+
+@app.before_first_request
+def start_background_threads():
+    if config.SNAPSHOT_POLL_INTERVAL:
+        background(watch_data)
+    if config.REFRESH_IN_WORKERS:
+        background(refresh.run, config.ORGANISATION_NAME)
+
+def window_query():
+    """?month= or ?days=, as requested_window reads them"""
+    requested_window()
+    month, days = request.args.get('month'), request.args.get('days')
+    return ('month', month) if month else ('days', int(days)) if days else ()
+
+def projects_query():
+    """?project=, each once, sorted"""
+    return tuple(sorted(set(request.args.getlist('project'))))
+
+def open_pulls_total(counts, projects):
+    return sum(counts.get(project, 0) for project in projects) if projects else sum(counts.values())
+
+def open_pulls_query():
+    """?project= and ?page=, a page there is"""
+    projects = projects_query()
+    try:
+        page = int(request.args.get('page', 1))
+    except ValueError:
+        abort(400)
+    total = open_pulls_total(aggregate_data(config.ORGANISATION_NAME)['open_pull_counts'], projects)
+    if not 0 < page <= max((total + config.OPEN_PULLS_PAGE_SIZE - 1) / config.OPEN_PULLS_PAGE_SIZE, 1):
+        abort(404)
+    return projects, page
+
+def api_query():
+    """?cursor=, ?limit= and ?fields=, as (offset, limit, fields)"""
+    try:
+        limit = int(request.args.get('limit', config.API_PAGE_SIZE))
+    except ValueError:
+        abort(400)
+    if not 0 < limit <= config.API_MAX_PAGE_SIZE:
+        abort(400)
+    cursor = request.args.get('cursor')
+    fields = request.args.get('fields')
+    if fields:
+        field_spec(fields)
+        fields = ','.join(sorted(set(field.strip() for field in fields.split(','))))
+    return decode_cursor(cursor) if cursor else 0, limit, fields or None
+
+def leaderboard_query():
+    if request.view_args['kind'] not in KINDS:
+        abort(404)
+    return window_query() + api_query()
+
+def api_open_pulls_query():
+    return projects_query() + api_query()
+
+def requested_window():
+    """The timeline days asked for with ?days=30 or ?month=2013-04, None for
+    all time"""
+    month, days = request.args.get('month'), request.args.get('days')
+    try:
+        if month:
+            return window_days(month=month)
+        if days and 0 < int(days) <= 366:
+            return window_days(days=int(days))
+    except ValueError:
+        abort(400)
+    if days:
+        abort(400)
+    return None
+
 @app.route('/')
+@cached(query=window_query)
 def index():
     """Shows a leaderboard of users, in two categories: pull request creators
     and commenters"""
     data = aggregate_data(config.ORGANISATION_NAME)
+    days = requested_window()
+    totals = data['totals'] if days is None else windowed_totals(data, days, config.LEADERBOARD_SIZE)
     return render_template('index.html',
             avatars      = data['user_avatars'],
-            pulls        = data['totals']['pulls'],
-            comments     = data['totals']['comments'],
-            projects     = data['raw']['projects'],
+            pulls        = totals['pulls'],
+            comments     = totals['comments'],
+            projects     = data['project_names'],
+            months       = data['months'],
             organisation = data['organisation'])
 
 @app.route('/user/<username>')
+@cached(query=window_query)
 def user(username):
     """Show project stats for this user"""
     data = aggregate_data(config.ORGANISATION_NAME)
+    days = requested_window()
     return render_template('user.html',
-            avatar        = data['user_avatars'][username],
+            avatar        = data['user_avatars'].get(username),
             organisation  = data['organisation'],
             username      = username,
-            user          = data['raw']['user_data'][username],
-            project_stats = data['users'][username])
+            user          = data['user_data'].get(username),
+            months        = data['months'],
+            project_stats = data['users'].get(username) if days is None else windowed_user_stats(data, username, days))
 
 @app.route('/projects/<projectname>')
+@cached(query=window_query)
 def project(projectname):
     """Show user stats for this project"""
     data = aggregate_data(config.ORGANISATION_NAME)
+    days = requested_window()
 
-    project_stats = data['projects'][projectname]
-    if project_stats:
+    project_stats = data['projects'].get(projectname)
+    if days is not None:
+        project_stats = windowed_project_stats(data, projectname, days)
+    elif project_stats:
+        # the aggregate is shared between requests, pop from a copy
+        project_stats = dict(project_stats)
         project_stats.pop('pulls')
         project_stats.pop('comments')
 
@@ -44,16 +373,120 @@ def project(projectname):
             organisation  = data['organisation'],
             projectname   = projectname,
             project_stats = project_stats,
-            project       = data['raw']['project_data'].get(projectname))
+            months        = data['months'],
+            project       = data['project_data'].get(projectname))
 
 @app.route('/open-pull-requests')
+@cached(query=open_pulls_query)
 def open_pulls():
-    """Displays currently open pull requests"""
-    pulls = open_pull_requests(config.ORGANISATION_NAME)
+    """Displays currently open pull requests, a page at a time, of every
+    project or those asked for with ?project="""
     data = aggregate_data(config.ORGANISATION_NAME)
-    return render_template('open_pull_requests.html',
-            open_pulls = pulls,
-            avatars = data['user_avatars'])
+    counts = data['open_pull_counts']
+    projects, page = open_pulls_query()
+    size = config.OPEN_PULLS_PAGE_SIZE
+    total = open_pulls_total(counts, projects)
+    last_page = max((total + size - 1) / size, 1)
+
+    return stream_template('open_pull_requests.html',
+            open_pulls = open_pull_requests(config.ORGANISATION_NAME, projects or None, (page - 1) * size, size),
+            body = rendered_body,
+            avatars = data['user_avatars'],
+            counts = counts,
+            projects = list(projects),
+            total = total,
+            page = page,
+            last_page = last_page)
+
+def field_spec(fields):
+    """The github.extract keys for ?fields=number,title,user.login"""
+    tree = {}
+    for field in fields.split(','):
+        node = tree
+        for name in field.strip().split('.'):
+            if not name:
+                abort(400)
+            node = node.setdefault(name, {})
+
+    def keys(tree):
+        return [name if not nested else {name: keys(nested)} for name, nested in sorted(tree.items())]
+    return keys(tree)
+
+def encode_cursor(offset):
+    # tied to the data version, an offset into a list that has since
+    # changed would skip or repeat items
+    return urlsafe_b64encode('%d:%s' % (offset, data_etag()[:12]))
+
+def decode_cursor(cursor):
+    try:
+        offset, version = urlsafe_b64decode(cursor.encode('ascii')).split(':')
+        offset = int(offset)
+    except (ValueError, TypeError, UnicodeError):
+        abort(400)
+    if offset < 0:
+        abort(400)
+    if version != data_etag()[:12]:
+        abort(410)      # the data has been refreshed, start again
+    return offset
+
+def api_list(items):
+    """A page of items as json, from ?cursor= (the previous page's next),
+    ?limit= and ?fields="""
+    return api_page(len(items), lambda offset, limit: items[offset:offset + limit])
+
+def api_page(total, page_of):
+    """api_list of total items, reading just the page asked for with
+    page_of(offset, limit)"""
+    offset, limit, fields = api_query()
+    page = page_of(offset, limit)
+    if fields:
+        keys = field_spec(fields)
+        page = [github.extract(item, keys) for item in page]
+    return json.dumps({
+        'items': page,
+        'total': total,
+        'next' : encode_cursor(offset + limit) if offset + limit < total else None,
+    })
+
+@app.route('/api/leaderboards/<kind>')
+@cached(mimetype='application/json', compress=True, query=leaderboard_query)
+def api_leaderboard(kind):
+    """The pulls or comments leaderboard, for ?days= or ?month= too"""
+    data = aggregate_data(config.ORGANISATION_NAME)
+    days = requested_window()
+    totals = data['totals'] if days is None else windowed_totals(data, days, config.LEADERBOARD_SIZE)
+    return api_list(totals[kind])
+
+@app.route('/api/open-pull-requests')
+@cached(mimetype='application/json', compress=True, query=api_open_pulls_query)
+def api_open_pulls():
+    """The open pull requests, of every project or those asked for with
+    ?project=, with their markdown bodies as written"""
+    projects = projects_query()
+    total = open_pulls_total(aggregate_data(config.ORGANISATION_NAME)['open_pull_counts'], projects)
+    return api_page(total, lambda offset, limit: open_pull_requests(config.ORGANISATION_NAME, projects or None, offset, limit))
+
+@app.route('/metrics')
+def metrics_page():
+    """Every web worker's metrics, merged, and the refresher's, for
+    Prometheus"""
+    path = snapshot_path(config.ORGANISATION_NAME)
+    if os.path.exists(path):
+        SNAPSHOT_AGE.set(refresh.data_age(config.ORGANISATION_NAME))
+        SNAPSHOT_BYTES.set(os.path.getsize(path))
+    save_metrics(now=True)
+
+    # the other workers' last saves (and the exited ones'), then ours as it is now
+    directory = workers_metrics_path()
+    retire_workers(directory)
+    ours = _metrics_saved['name']
+    workers = [metrics.read_state(os.path.join(directory, name)) for name in sorted(os.listdir(directory))
+        if name.endswith('.json') and name != ours]
+    others = []
+    if not config.REFRESH_IN_WORKERS:
+        others.append(({'process': 'refresh'}, metrics.read_state(refresh.metrics_path(config.ORGANISATION_NAME))))
+    return Response(metrics.render(metrics.merge(workers + [metrics.state()]), others),
+        mimetype='text/plain; version=0.0.4')
 
 if __name__ == "__main__":
     app.run(host='0.0.0.0', debug=True)
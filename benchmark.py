@@ -0,0 +1,232 @@
+""" Offline benchmarks of the ingest, store and web paths, over a synthetic
+organisation served by fakehub.FakeGitHub, and with --http over http from
+fakehub.py.
+
+    $ python benchmark.py --repos 200 --pulls 50 --output before.json
+    $ python benchmark.py --repos 200 --pulls 50 --compare before.json
+
+Each stage is run --repeat times and the fastest kept, with the process's
+peak resident memory after it. Peak memory only grows, so a stage's figure
+includes the stages before it: compare the same stage between runs.
+
+"""
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+import omnijson as json
+import config
+
+ORGANISATION = 'synthetic'
+WORDS = ('fix', 'add', 'remove', 'the', 'cache', 'store', 'page', 'user', 'project', 'test',
+         'refactor', 'template', 'github', 'comment', 'pull', 'request', 'count', 'merge')
+
+def synthetic_org(repos=20, pulls=20, comments=3, users=50, body_length=200, seed=1):
+    """A store-shaped organisation: repos repositories with up to pulls pull
+    requests each, averaging comments comments per pull request, from users
+    users (a few of them much busier than the rest)"""
+    rand = random.Random(seed)
+    logins = ['user%d' % n for n in range(users)]
+    start = datetime(2013, 1, 1)
+
+    def login():
+        # a long tail, like real organisations
+        return logins[min(int(rand.paretovariate(1.2)) - 1, users - 1)]
+
+    def text(length):
+        words = []
+        while sum(len(word) + 1 for word in words) < length:
+            words.append(rand.choice(WORDS))
+        return ' '.join(words)
+
+    def timestamp(day):
+        return (start + timedelta(days=day, seconds=rand.randint(0, 86399))).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    projects = ['repo%d' % n for n in range(repos)]
+    pulls_per_project = {}
+    comments_per_project = {}
+    comment_id = 0
+    for index, project in enumerate(projects):
+        project_pulls = pulls_per_project[project] = []
+        project_comments = comments_per_project[project] = []
+        for number in range(1, rand.randint(0, pulls) + 1):
+            day = rand.randint(0, 364)
+            author = login()
+            project_pulls.append({
+                'id': len(projects) * number + index,
+                'number': number,
+                'state': 'open' if rand.random() < 0.1 else 'closed',
+                'created_at': timestamp(day),
+                'updated_at': timestamp(day + 1),
+                'title': text(40),
+                'body': text(body_length),
+                'html_url': 'https://github.com/%s/%s/pull/%d' % (ORGANISATION, project, number),
+                'user': {'login': author, 'avatar_url': 'https://avatars/%s' % author},
+                'base': {'repo': {'name': project}},
+            })
+            for _ in range(int(rand.expovariate(1.0 / comments)) if comments else 0):
+                comment_id += 1
+                commenter = login()
+                project_comments.append({
+                    'id': comment_id,
+                    'body': text(body_length / 4),
+                    'created_at': timestamp(day),
+                    'updated_at': timestamp(day),
+                    'html_url': 'https://github.com/%s/%s/pull/%d#comment-%d' % (ORGANISATION, project, number, comment_id),
+                    'pull_request_url': 'https://api.github.com/repos/%s/%s/pulls/%d' % (ORGANISATION, project, number),
+                    'user': {'login': commenter, 'avatar_url': 'https://avatars/%s' % commenter},
+                })
+
+    return {
+        'pull_requests'                    : [pull for project in projects for pull in pulls_per_project[project]],
+        'pull_requests_per_project'        : pulls_per_project,
+        'pull_request_comments'            : [comment for project in projects for comment in comments_per_project[project]],
+        'pull_request_comments_per_project': comments_per_project,
+        'projects'                         : projects,
+        'projects_with_pulls'              : [project for project in projects if pulls_per_project[project]],
+        'organisation'                     : {'login': ORGANISATION, 'name': 'Synthetic'},
+        'user_data'                        : dict((user, {'login': user, 'name': user.title()}) for user in logins),
+        'project_data'                     : dict((project, {'name': project}) for project in projects),
+    }
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def benchmark(options):
+    from fakehub import FakeGitHub
+    from dictionaries import PersistentDict
+    import github
+    import store
+    import app
+
+    data = synthetic_org(options.repos, options.pulls, options.comments, options.users, options.body_length, options.seed)
+    stages = []
+
+    def timed(name, function):
+        times = []
+        for _ in range(options.repeat):
+            started = time.time()
+            function()
+            times.append(time.time() - started)
+        stages.append({'stage': name, 'seconds': min(times), 'peak_rss_mb': peak_rss_mb()})
+        print '%-40s %8.3fs %8.1fMB' % (name, min(times), peak_rss_mb())
+
+    def ingest():
+        api, github.github_api = github.github_api, FakeGitHub(data)
+        try:
+            store.load_data(ORGANISATION, update=True)
+        finally:
+            github.github_api = api
+
+    def parse():
+        store._snapshots.clear()
+        store.load_data(ORGANISATION)
+
+    persistent_path = os.path.join(config.STORE, 'persistent.json')
+    def dump():
+        with PersistentDict(persistent_path, 'n', format='json') as d:
+            d.update(store.normalise(data))
+
+    def mapped():
+        store._snapshots.clear()
+        store.aggregate_data(ORGANISATION)
+
+    timed('ingest (load_data update=True)', ingest)
+    if options.http:
+        import fakehub
+        hub = fakehub.FakeHub(data, options.latency)
+        server = fakehub.start(hub)
+        config.GITHUB_API_URL = server.url
+        try:
+            timed('ingest over http (fakehub)', lambda: store.load_data(ORGANISATION, update=True))
+        finally:
+            server.shutdown()
+        stage = stages[-1]
+        stage['api_calls'] = hub.requests / options.repeat
+        stage['api_calls_per_second'] = stage['api_calls'] / stage['seconds']
+        print '%-40s %8d calls, %.0f/s' % ('', stage['api_calls'], stage['api_calls_per_second'])
+    timed('parse store (load_data)', parse)
+    timed('PersistentDict dump', dump)
+    timed('PersistentDict load', lambda: PersistentDict(persistent_path, 'r', format='json'))
+    timed('aggregate (compute_aggregate)', lambda: store.compute_aggregate(data))
+    timed('write_aggregate', lambda: store.write_aggregate(ORGANISATION, data))
+    timed('map snapshot (aggregate_data)', mapped)
+    timed('aggregate_stats', lambda: store.aggregate_stats(ORGANISATION))
+
+    aggregate = store.aggregate_data(ORGANISATION)
+    busiest_user = aggregate['totals']['comments'][0]['login'] if aggregate['totals']['comments'] else 'user0'
+    busiest_project = max(data['projects'], key=lambda project: len(data['pull_requests_per_project'][project]))
+    client = app.app.test_client()
+    for url in ['/', '/?month=2013-06', '/user/%s' % busiest_user, '/projects/%s' % busiest_project, '/open-pull-requests']:
+        def cold(url=url):
+            app.pages.clear()
+            app.bodies.clear()
+            response = client.get(url)
+            assert response.status_code == 200
+            response.data       # streamed pages render as they are read
+        timed('GET %s (rendered)' % url, cold)
+        timed('GET %s (page cache)' % url, lambda url=url: client.get(url).data)
+
+    return {
+        'revision' : revision(),
+        'timestamp': datetime.utcnow().isoformat(),
+        'python'   : sys.version.split()[0],
+        'params'   : dict((key, getattr(options, key)) for key in ('repos', 'pulls', 'comments', 'users', 'body_length', 'seed', 'repeat', 'http', 'latency')),
+        'size'     : {'pull_requests': len(data['pull_requests']), 'comments': len(data['pull_request_comments']),
+                      'store_bytes': os.path.getsize(store.store_path(ORGANISATION))},
+        'stages'   : stages,
+    }
+
+def compare(results, previous):
+    before = dict((stage['stage'], stage) for stage in previous['stages'])
+    if previous['params'] != results['params']:
+        print 'WARNING: comparing runs with different parameters: %s' % previous['params']
+    print '\n%-40s %9s %9s %7s' % ('stage (vs %s)' % previous.get('revision'), 'before', 'after', 'ratio')
+    for stage in results['stages']:
+        if stage['stage'] in before:
+            was = before[stage['stage']]['seconds']
+            print '%-40s %8.3fs %8.3fs %6.2fx' % (stage['stage'], was, stage['seconds'], stage['seconds'] / was if was else 0)
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark inquisition against a synthetic organisation')
+    parser.add_argument('--repos', type=int, default=50)
+    parser.add_argument('--pulls', type=int, default=40, help='the most pull requests per repository')
+    parser.add_argument('--comments', type=int, default=4, help='the average comments per pull request')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--body-length', type=int, default=400)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--http', action='store_true', help='also time the ingest over http, from fakehub.py')
+    parser.add_argument('--latency', type=float, default=0, help="seconds added to each of fakehub's responses")
+    parser.add_argument('--output', help='write the results, as json, here')
+    parser.add_argument('--compare', help='the results of an earlier run to compare with')
+    options = parser.parse_args()
+
+    config.STORE = tempfile.mkdtemp()
+    config.ORGANISATION_NAME = ORGANISATION
+    config.GITHUB_CACHE_MAX_BYTES = 0
+    config.PAGE_CACHE_WARM = False
+    config.SNAPSHOT_POLL_INTERVAL = 0
+    try:
+        results = benchmark(options)
+    finally:
+        shutil.rmtree(config.STORE)
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(json.dumps(results))
+    if options.compare:
+        with open(options.compare) as f:
+            compare(results, json.loads(f.read()))
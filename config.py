@@ -7,5 +7,75 @@ GITHUB_USER = 'my-github-username'
 GITHUB_PASSWORD = 'my-github-password'
 ORGANISATION_NAME = 'my-organisation-name'
 
+# The github api, or a stand-in for it like fakehub.py ('http://localhost:8001').
+# The credentials are only sent to this host, and over http only to localhost.
+GITHUB_API_URL = 'https://api.github.com'
+
 # The directory to store the github json data file
 STORE = '.'
+
+# The maximum number of concurrent requests to the github api
+GITHUB_CONCURRENCY = 8
+
+# Connections kept alive to the github api, retries (with exponential
+# backoff, in seconds) of failed requests and the number of remaining
+# requests at which we wait for the rate limit to reset
+GITHUB_POOL_SIZE = 8
+GITHUB_RETRIES = 3
+GITHUB_BACKOFF = 0.5
+GITHUB_RATE_LIMIT_THRESHOLD = 10
+
+# Items requested per page of a github listing (100 is the most allowed)
+GITHUB_PER_PAGE = 100
+
+# Size of the conditional request cache kept in STORE/http-cache, 0 disables it
+GITHUB_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Fetch each repository's pull request comments in one (paginated) listing
+# rather than a request per pull request
+GITHUB_BULK_COMMENTS = True
+
+# The fields kept from github's pull requests, comments, users, organisation
+# and repositories at ingest, see github.extract. None keeps everything.
+PULL_REQUEST_FIELDS = ['id', 'number', 'state', 'title', 'body', 'html_url',
+    'created_at', 'updated_at', 'closed_at', 'merged_at',
+    {'user': ['login', 'avatar_url']}, {'base': [{'repo': ['name']}]}]
+COMMENT_FIELDS = ['id', 'body', 'html_url', 'pull_request_url', 'created_at', 'updated_at',
+    {'user': ['login', 'avatar_url']}]
+USER_FIELDS = ['login', 'name', 'avatar_url', 'html_url', 'public_repos', 'public_gists', 'followers', 'following']
+ORGANISATION_FIELDS = ['login', 'name', 'avatar_url', 'html_url', 'public_repos', 'followers']
+PROJECT_FIELDS = ['name', 'html_url', 'description', 'language', 'forks', 'watchers', 'open_issues']
+
+# The most users shown on a leaderboard for a time window (?days=30 or
+# ?month=2013-04), None shows everyone
+LEADERBOARD_SIZE = None
+
+# The most rendered pages kept in memory, and whether to render the index,
+# user and project pages in the background as soon as a refresh is seen
+PAGE_CACHE_SIZE = 2048
+PAGE_CACHE_WARM = True
+
+# The most open pull request bodies kept rendered to html
+BODY_CACHE_SIZE = 4096
+
+# Seconds between refreshes of the store by refresh.py, plus up to
+# REFRESH_JITTER at random. With REFRESH_IN_WORKERS the web workers run the
+# refreshes themselves, one at a time, instead.
+REFRESH_INTERVAL = 3600
+REFRESH_JITTER = 300
+REFRESH_IN_WORKERS = False
+
+# Seconds between the web workers' checks for a newly published snapshot,
+# which they map and render ahead of the requests. 0 leaves it to requests.
+SNAPSHOT_POLL_INTERVAL = 10
+
+# Seconds between each web worker's saves of its metrics to
+# STORE/<organisation>.workers, which /metrics adds up across the workers
+METRICS_SAVE_INTERVAL = 10
+
+# Items per page of the /api listings, by default and at most (?limit=)
+API_PAGE_SIZE = 100
+API_MAX_PAGE_SIZE = 1000
+
+# Open pull requests shown per page of /open-pull-requests
+OPEN_PULLS_PAGE_SIZE = 50
@@ -125,11 +125,26 @@ class Counter(dict):
         '''
         if not isinstance(other, Counter):
             return NotImplemented
-        result = Counter()
-        for elem in set(self) | set(other):
-            newcount = self[elem] + other[elem]
-            if newcount > 0:
-                result[elem] = newcount
+        result = Counter(self)                  # fast path copy of self
+        for elem, count in other.iteritems():
+            result[elem] += count
+        for elem in [elem for elem, count in result.iteritems() if count <= 0]:
+            del result[elem]
+        return result
+
+    @classmethod
+    def merge(cls, counters):
+        '''Sum any number of counters (or mappings of counts) into a new one,
+        updating a copy of the largest in place with each of the others.
+
+        >>> Counter.merge([Counter('abbb'), Counter('bcc'), {'a': 1}])
+        Counter({'b': 4, 'a': 2, 'c': 2})
+
+        '''
+        counters = sorted(counters, key=len, reverse=True)
+        result = cls(counters[0]) if counters else cls()
+        for counter in counters[1:]:
+            result.update(counter)
         return result
 
     def __sub__(self, other):
@@ -1,3 +1,6 @@
+import threading
+from collections import OrderedDict
+
 ## {{{ http://code.activestate.com/recipes/576642/ (r10)
 import pickle, json, csv, os, shutil
 
@@ -75,6 +78,34 @@ class PersistentDict(dict):
 
 ## end of http://code.activestate.com/recipes/576642/ }}}
 
+class LRUDict(OrderedDict):
+    """ Dictionary of at most max_size items, dropping the least recently
+    used when full. Setting an item and get() count as a use. Both are
+    locked, so the dict can be shared between threads.
+
+    """
+
+    def __init__(self, max_size, *args, **kwds):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        OrderedDict.__init__(self, *args, **kwds)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self:
+                return default
+            value = OrderedDict.pop(self, key)
+            OrderedDict.__setitem__(self, key, value)
+            return value
+
+    def __setitem__(self, key, value, *args):
+        with self.lock:
+            if key in self:
+                OrderedDict.__delitem__(self, key)
+            OrderedDict.__setitem__(self, key, value)
+            while len(self) > self.max_size:
+                self.popitem(last=False)
+
 # https://github.com/vkuznet/DotDict
 #-*- coding: ISO-8859-1 -*-
 """
@@ -111,7 +142,7 @@ def isdictinstance(obj):
     """
     Return if provided object is type of dict or instance of DotDict class
     """
-    return isinstance(obj, dict) or isinstance(obj, DotDict)
+    return isinstance(obj, dict) or isinstance(obj, DotDict) or isinstance(obj, DotDictView)
 
 def convert_dot_notation(key, val):
     """
@@ -152,23 +183,76 @@ def yield_obj(rdict, ckey):
 def helper_loop(combo, vals):
     "Helper function"
     if  isinstance(vals, dict):
-        for kkk in DotDict(vals).get_keys():
+        for kkk in dict_keys(vals):
             yield '%s.%s' % (combo, kkk)
     elif isinstance(vals, list):
         for item in vals:
             if  isinstance(item, dict):
-                for kkk in DotDict(item).get_keys():
+                for kkk in dict_keys(item):
                     yield '%s.%s' % (combo, kkk)
 
+def walk_keys(rdict, ckey):
+    """Helper generator which yields all keys of a dict (or DotDict) for a
+    starting ckey"""
+    if  rdict.has_key(ckey):
+        doc = rdict[ckey]
+    else:
+        doc = [o for o in DotDict.get_values.im_func(rdict, ckey)]
+    if  isinstance(doc, dict):
+        for key in doc.keys():
+            if  ckey.rfind('%s.' % key) == -1:
+                combo = '%s.%s' % (ckey, key)
+                yield combo
+                vals = [v for v in DotDict.get_values.im_func(rdict, combo)]
+                for kkk in helper_loop(combo, vals):
+                    yield kkk
+            else:
+                yield ckey
+    elif isinstance(doc, list):
+        for item in doc:
+            if  isinstance(item, dict):
+                for key in item.keys():
+                    if  ckey.rfind('%s.' % key) == -1:
+                        combo = '%s.%s' % (ckey, key)
+                        yield combo
+                        vals = [v for v in DotDict.get_values.im_func(rdict, combo)]
+                        for kkk in helper_loop(combo, vals):
+                            yield kkk
+            elif isinstance(item, list):
+                for elem in item:
+                    if  isinstance(elem, dict):
+                        for kkk in elem.keys():
+                            yield '%s.%s' % (ckey, kkk)
+                    else:
+                        yield ckey
+            else: # basic type, so we reach the end
+                yield ckey
+    else: # basic type, so we reach the end
+        yield ckey
+
+def dict_keys(rdict, ckey=None):
+    """Return all keys of a dict (or DotDict) for a starting ckey"""
+    if  ckey:
+        keys = list(walk_keys(rdict, ckey))
+    else:
+        keys = rdict.keys()
+        for key in rdict.keys():
+            keys += [k for k in walk_keys(rdict, key)]
+    return list(set(keys))
+
 class DotDict(dict):
     """
     Access python dictionaries via dot notations, original idea taken from
     http://parand.com/say/index.php/2008/10/24/python-dot-notation-dictionary-access/
     Class has been extended with helper method to use compound keys, e.g. a.b.c.
     All extended method follow standard python dictionary syntax.
+
+    With view=True nested dicts are returned as DotDictView proxies rather
+    than DotDict copies.
     """
-    def __init__(self, idict):
+    def __init__(self, idict, view=False):
         super(DotDict, self).__init__(idict)
+        object.__setattr__(self, '_view', view)
 
     __setattr__ = dict.__setitem__
     __delattr__ = dict.__delitem__
@@ -177,9 +261,15 @@ class DotDict(dict):
         """Overwriten __getattr__ method"""
         obj = super(DotDict, self).get(key, None)
         if  isinstance(obj, dict):
-            return DotDict(obj)
+            return self._nested(obj)
         return obj
 
+    def _nested(self, obj):
+        """Wrap a nested dict, as a view or a copy"""
+        if  self.__dict__.get('_view'):
+            return DotDictView(obj)
+        return DotDict(obj)
+
     def __getitem__(self, key):
         """Overwriten __getitem__ method"""
         return self.get(key)
@@ -222,41 +312,7 @@ class DotDict(dict):
 
     def _get_keys(self, ckey):
         """Helper generator which yields all keys for a starting ckey"""
-        if  self.has_key(ckey):
-            doc = self[ckey]
-        else:
-            doc = [o for o in self.get_values(ckey)]
-        if  isinstance(doc, dict):
-            for key in doc.keys():
-                if  ckey.rfind('%s.' % key) == -1:
-                    combo = '%s.%s' % (ckey, key)
-                    yield combo
-                    vals = [v for v in self.get_values(combo)]
-                    for kkk in helper_loop(combo, vals):
-                        yield kkk
-                else:
-                    yield ckey
-        elif isinstance(doc, list):
-            for item in doc:
-                if  isinstance(item, dict):
-                    for key in item.keys():
-                        if  ckey.rfind('%s.' % key) == -1:
-                            combo = '%s.%s' % (ckey, key)
-                            yield combo
-                            vals = [v for v in self.get_values(combo)]
-                            for kkk in helper_loop(combo, vals):
-                                yield kkk
-                elif isinstance(item, list):
-                    for elem in item:
-                        if  isinstance(elem, dict):
-                            for kkk in elem.keys():
-                                yield '%s.%s' % (ckey, kkk)
-                        else:
-                            yield ckey
-                else: # basic type, so we reach the end
-                    yield ckey
-        else: # basic type, so we reach the end
-            yield ckey
+        return walk_keys(self, ckey)
 
     ### public methods
     def delete(self, ckey):
@@ -286,18 +342,18 @@ class DotDict(dict):
             obj = super(DotDict, self).__getitem__(first)
             if  first == ckey:
                 if  isinstance(obj, dict):
-                    return DotDict(obj)
+                    return self._nested(obj)
                 else:
                     return obj
             if  isdictinstance(obj):
-                return DotDict(obj).get('.'.join(keys[1:]))
+                return self._nested(obj).get('.'.join(keys[1:]))
             elif isinstance(obj, list):
                 for elem in obj:
                     if  isdictinstance(elem):
                         newobj = elem.get('.'.join(keys[1:]))
                         if  newobj:
                             if  isinstance(newobj, dict):
-                                return DotDict(newobj)
+                                return self._nested(newobj)
                             return newobj
         return obj
 
@@ -323,10 +379,101 @@ class DotDict(dict):
 
     def get_keys(self, ckey=None):
         """Return all keys for a starting ckey"""
-        if  ckey:
-            keys = self._get_keys(ckey)
-        else:
-            keys = self.keys()
-            for key in self.keys():
-                keys += [k for k in self._get_keys(key)]
-        return list(set(keys))
+        return dict_keys(self, ckey)
+
+class DotDictView(object):
+    """
+    Read-only DotDict over an existing dict. Lookups return the same values
+    as DotDict, but nested dicts come back as views over the underlying
+    dicts instead of DotDict copies, and get_keys results are cached, so the
+    underlying dict must not change while the view is in use.
+    """
+    __slots__ = ('_dict', '_keys')
+
+    def __init__(self, idict):
+        if  isinstance(idict, DotDictView):
+            idict = idict._dict
+        self._dict = idict
+        self._keys = {}
+
+    def __getattr__(self, key):
+        """DotDict style attribute access, None for missing keys"""
+        if  key.startswith('__'):
+            raise AttributeError(key)
+        obj = self._dict.get(key, None)
+        if  isinstance(obj, dict):
+            return DotDictView(obj)
+        return obj
+
+    def __getitem__(self, key):
+        return self.get(key)
+
+    def __contains__(self, key):
+        return key in self._dict
+
+    def __iter__(self):
+        return iter(self._dict)
+
+    def __len__(self):
+        return len(self._dict)
+
+    def __eq__(self, other):
+        if  isinstance(other, DotDictView):
+            other = other._dict
+        return self._dict == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self._dict)
+
+    def has_key(self, key):
+        return key in self._dict
+
+    def keys(self):
+        return self._dict.keys()
+
+    def values(self):
+        return self._dict.values()
+
+    def items(self):
+        return self._dict.items()
+
+    def iteritems(self):
+        return self._dict.iteritems()
+
+    def get(self, ckey, default=None):
+        """
+        Get value for provided compound key, see DotDict.get
+        """
+        obj = default
+        keys = ckey.split('.')
+        first = keys[0]
+        if  first in self._dict:
+            obj = self._dict[first]
+            if  first == ckey:
+                if  isinstance(obj, dict):
+                    return DotDictView(obj)
+                return obj
+            if  isdictinstance(obj):
+                return DotDictView(obj).get('.'.join(keys[1:]))
+            elif isinstance(obj, list):
+                for elem in obj:
+                    if  isdictinstance(elem):
+                        newobj = elem.get('.'.join(keys[1:]))
+                        if  newobj:
+                            if  isinstance(newobj, dict):
+                                return DotDictView(newobj)
+                            return newobj
+        return obj
+
+    def get_values(self, ckey):
+        """Generator which yields values for any compound key"""
+        return DotDict.get_values.im_func(self._dict, ckey)
+
+    def get_keys(self, ckey=None):
+        """Return all keys for a starting ckey, computed once per ckey"""
+        if  ckey not in self._keys:
+            self._keys[ckey] = dict_keys(self._dict, ckey)
+        return self._keys[ckey]
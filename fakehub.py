@@ -0,0 +1,218 @@
+""" A local stand-in for the parts of the github api that inquisition reads,
+serving a synthetic organisation (see benchmark.synthetic_org) or a recorded
+store, so the ingest can be run and tuned without touching github.
+
+    $ python fakehub.py --repos 200 --pulls 50 --latency 0.05 --rate-limit 5000
+    $ python fakehub.py --store yola.json --port 8001
+
+and point config.GITHUB_API_URL at it ('http://localhost:8001').
+
+Listings are paginated with Link headers, every response carries the
+X-RateLimit headers, and once the rate limit is used up requests get a 403
+until it resets, like github's.
+
+FakeGitHub answers the same data in process, in place of github.github_api,
+for the tests and benchmark.py.
+
+"""
+import threading
+import time
+from argparse import ArgumentParser
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urllib import urlencode
+from urlparse import urlparse, parse_qsl
+from requests.utils import parse_header_links
+import omnijson as json
+
+class FakeHub(object):
+    """ Answers github api paths from store-shaped data """
+
+    def __init__(self, data, latency=0, rate_limit=None, rate_limit_window=3600):
+        self.data = data
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.rate_limit_window = rate_limit_window
+        self.remaining = rate_limit
+        self.reset = int(time.time()) + rate_limit_window
+        self.requests = 0
+        self.lock = threading.Lock()
+
+        self.comments_per_pull = {}
+        for project, comments in data['pull_request_comments_per_project'].items():
+            for comment in comments:
+                number = int(comment['pull_request_url'].rsplit('/', 1)[1])
+                self.comments_per_pull.setdefault((project, number), []).append(comment)
+
+    def take_request(self):
+        """Counts a request against the rate limit, returning whether it is
+        allowed and the X-RateLimit headers"""
+        with self.lock:
+            self.requests += 1
+            if self.rate_limit is None:
+                return True, {}
+            if time.time() >= self.reset:
+                self.remaining = self.rate_limit
+                self.reset = int(time.time()) + self.rate_limit_window
+            allowed = self.remaining > 0
+            if allowed:
+                self.remaining -= 1
+            return allowed, {
+                'X-RateLimit-Limit'    : str(self.rate_limit),
+                'X-RateLimit-Remaining': str(self.remaining),
+                'X-RateLimit-Reset'    : str(self.reset),
+            }
+
+    def payload(self, path, params):
+        """The json github would send for path, None for a 404"""
+        parts = path.strip('/').split('/')
+        data = self.data
+        if parts[0] == 'orgs' and len(parts) == 2:
+            return data['organisation']
+        if parts[0] == 'orgs' and parts[2:] == ['repos']:
+            return [dict(data['project_data'].get(project) or {}, name=project, fork=False) for project in data['projects']]
+        if parts[0] == 'users' and len(parts) == 2:
+            return data['user_data'].get(parts[1])
+        if parts[0] != 'repos' or len(parts) < 4 or parts[3] != 'pulls':
+            return None
+
+        project = parts[2]
+        if len(parts) == 4:
+            state = params.get('state', 'open')
+            key = 'updated_at' if params.get('sort') == 'updated' else 'created_at'
+            pulls = [pull for pull in data['pull_requests_per_project'].get(project, []) if state in ('all', pull['state'])]
+            return sorted(pulls, key=lambda pull: pull[key], reverse=params.get('direction', 'desc') == 'desc')
+        if parts[4:] == ['comments']:
+            since = params.get('since', '')
+            comments = data['pull_request_comments_per_project'].get(project, [])
+            return sorted([comment for comment in comments if comment['updated_at'] >= since], key=lambda comment: comment['id'])
+        if len(parts) == 6 and parts[5] == 'comments':
+            return sorted(self.comments_per_pull.get((project, int(parts[4])), []), key=lambda comment: comment['id'])
+        return None
+
+    def respond(self, url, base_url):
+        """(status, headers, body) for a request of url"""
+        if self.latency:
+            time.sleep(self.latency)
+        allowed, headers = self.take_request()
+        if not allowed:
+            return 403, headers, json.dumps({'message': 'API rate limit exceeded'})
+
+        parsed = urlparse(url)
+        params = dict(parse_qsl(parsed.query))
+        payload = self.payload(parsed.path, params)
+        if payload is None:
+            return 404, headers, json.dumps({'message': 'Not Found'})
+
+        if isinstance(payload, list):
+            page, per_page = int(params.get('page', 1)), min(int(params.get('per_page', 30)), 100)
+            pages = max((len(payload) + per_page - 1) / per_page, 1)
+            links = []
+            if page < pages:
+                links.append('<%s%s?%s>; rel="next"' % (base_url, parsed.path, urlencode(sorted(dict(params, page=page + 1).items()))))
+                links.append('<%s%s?%s>; rel="last"' % (base_url, parsed.path, urlencode(sorted(dict(params, page=pages).items()))))
+            if links:
+                headers['Link'] = ', '.join(links)
+            payload = payload[(page - 1) * per_page:page * per_page]
+        return 200, headers, json.dumps(payload)
+
+
+class FakeResponse(object):
+    """ The parts of a requests response that github.py reads """
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.headers = headers
+        self.content = content
+        self.links = dict((link['rel'], link) for link in parse_header_links(headers.get('Link', '')))
+
+
+class FakeGitHub(object):
+    """Stands in for github.github_api itself, answering its paths from a
+    FakeHub of store-shaped data (like tests.sample_store()), without http.
+    Its Link headers are paths, like those github_api is called with."""
+    def __init__(self, data, **options):
+        self.hub = FakeHub(data, **options)
+        self.paths = []
+
+    def __call__(self, path, params=None):
+        self.paths.append(path)
+        if params:
+            path += ('&' if '?' in path else '?') + urlencode(sorted(params.items()))
+        return FakeResponse(*self.hub.respond(path, ''))
+
+
+class FakeHubHandler(BaseHTTPRequestHandler):
+    wbufsize = -1       # one write per response, rather than per header
+
+    def do_GET(self):
+        server = self.server
+        status, headers, body = server.hub.respond(self.path, 'http://%s:%d' % server.server_address[:2])
+        self.send_response(status)
+        headers['Content-Type'] = 'application/json; charset=utf-8'
+        headers['Content-Length'] = str(len(body))
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class FakeHubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    protocol_version = 'HTTP/1.1'       # keep-alive, like github
+
+    def __init__(self, hub, address=('127.0.0.1', 8001), verbose=False):
+        HTTPServer.__init__(self, address, FakeHubHandler)
+        self.hub = hub
+        self.verbose = verbose
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address[:2]
+
+def start(hub, port=0):
+    """Serves hub from a background thread, returning the server (its url
+    is server.url, shut it down with server.shutdown())"""
+    server = FakeHubServer(hub, ('127.0.0.1', port))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Serve a synthetic (or recorded) organisation like the github api')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--store', help='serve this store file rather than a synthetic organisation')
+    parser.add_argument('--repos', type=int, default=50)
+    parser.add_argument('--pulls', type=int, default=40, help='the most pull requests per repository')
+    parser.add_argument('--comments', type=int, default=4, help='the average comments per pull request')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--body-length', type=int, default=400)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every response')
+    parser.add_argument('--rate-limit', type=int, help='requests allowed per --rate-limit-window seconds')
+    parser.add_argument('--rate-limit-window', type=int, default=3600)
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    options = parser.parse_args()
+
+    if options.store:
+        import store
+        with open(options.store, 'rb') as f:
+            data = store.denormalise(json.loads(f.read()))
+    else:
+        from benchmark import synthetic_org
+        data = synthetic_org(options.repos, options.pulls, options.comments, options.users, options.body_length, options.seed)
+
+    hub = FakeHub(data, options.latency, options.rate_limit, options.rate_limit_window)
+    server = FakeHubServer(hub, ('127.0.0.1', options.port), options.verbose)
+    print '[fakehub] serving %s (%d pull requests) at %s' % (
+        (data['organisation'] or {}).get('login'), len(data['pull_requests']), server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print '[fakehub] served %d requests' % hub.requests
@@ -1,53 +1,290 @@
+import os
+import time
+import threading
+from itertools import chain
+from multiprocessing.pool import ThreadPool
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 import omnijson as json
+from urlparse import urlparse
+from httpcache import ResponseCache
+import metrics
 import config
 
+# bounds the requests in flight, however far the fetches below fan out
+_api_slots = threading.BoundedSemaphore(config.GITHUB_CONCURRENCY)
+
+# what github last told us about our quota, how long we waited on it and
+# which requests failed outright, see api_report()
+_api_report_lock = threading.Lock()
+_rate_limit = {}
+_throttled = []
+_failures = []
+
+API_REQUESTS = metrics.Counter('inquisition_github_requests_total', 'Requests to the github api', ['endpoint', 'status'])
+API_SECONDS = metrics.Histogram('inquisition_github_request_seconds', 'Github api response times', ['endpoint'])
+API_BYTES = metrics.Counter('inquisition_github_response_bytes_total', 'Bytes read from the github api', ['endpoint'])
+API_RATE_LIMIT_REMAINING = metrics.Gauge('inquisition_github_rate_limit_remaining', 'Github api requests left until the rate limit resets')
+
+def endpoint(url):
+    """The api path of url with its names and numbers replaced by
+    placeholders, like /repos/:owner/:repo/pulls/:number/comments"""
+    parts = urlparse(url).path.strip('/').split('/')
+    placeholders = {'repos': [':owner', ':repo'], 'orgs': [':org'], 'users': [':login']}.get(parts[0], [])
+    parts[1:len(placeholders) + 1] = placeholders[:len(parts) - 1]
+    return '/' + '/'.join(':number' if part.isdigit() else part for part in parts)
+
+LOCAL_HOSTS = ('localhost', '127.0.0.1', '::1')
+
+def api_session():
+    session = requests.Session()
+    retries = Retry(total=config.GITHUB_RETRIES, backoff_factor=config.GITHUB_BACKOFF,
+        status_forcelist=(429, 500, 502, 503, 504), raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config.GITHUB_POOL_SIZE, max_retries=retries)
+    # http too, for a local stand-in (see fakehub.py); api_auth keeps the
+    # credentials off plain http to anywhere else
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def api_auth(url):
+    """The credentials to send with a request of url: only to the
+    GITHUB_API_URL host, and never in the clear, bar to a local stand-in
+    (see fakehub.py)"""
+    target, api = urlparse(url), urlparse(config.GITHUB_API_URL)
+    if (target.scheme, target.netloc) != (api.scheme, api.netloc):
+        return None
+    if target.scheme != 'https' and target.hostname not in LOCAL_HOSTS:
+        return None
+    return (config.GITHUB_USER, config.GITHUB_PASSWORD)
+
+session = api_session()
+
+# made on first use, by whichever of fetch_all's threads gets there first
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+def response_cache():
+    """The conditional request cache under config.STORE, None if disabled"""
+    global _response_cache
+    if not config.GITHUB_CACHE_MAX_BYTES:
+        return None
+    directory = os.path.join(config.STORE, 'http-cache')
+    with _response_cache_lock:
+        if _response_cache is None or _response_cache.directory != directory:
+            _response_cache = ResponseCache(directory, config.GITHUB_CACHE_MAX_BYTES)
+        return _response_cache
+
 def extract(d, keys):
-    extracted = dict((k, d[k]) for k in keys if not isinstance(k, list) and k in d)
+    """The keys of d, where a key can also be a path (a list) to a nested
+    value, or a dict of {key: keys} to extract from a nested dict"""
+    extracted = dict((k, d[k]) for k in keys if isinstance(k, basestring) and k in d)
     for key in keys:
         if isinstance(key, list):
-            value = d[key.pop(0)]
-            for k in key:
+            value = d[key[0]]
+            for k in key[1:]:
                 value = value[k]
-            extracted[key[0]] = value
+            extracted[key[1]] = value
+        elif isinstance(key, dict):
+            for k, nested_keys in key.items():
+                if k in d:
+                    extracted[k] = extract(d[k], nested_keys) if isinstance(d[k], dict) else d[k]
     return extracted
 
-def github_api(path, data=None):
-    return requests.get('https://api.github.com' + path, data=data, auth=(config.GITHUB_USER, config.GITHUB_PASSWORD))
+def github_api(path, params=None):
+    # paths, or the absolute urls github hands out in Link headers
+    url = path if path.startswith(('https://', 'http://')) else config.GITHUB_API_URL + path
+
+    cache = response_cache()
+    cached = cache.get(url, params) if cache else None
+
+    name = endpoint(url)
+    for attempt in range(config.GITHUB_RETRIES + 1):
+        wait_for_rate_limit()
+        with _api_slots:
+            with API_SECONDS.time(endpoint=name):
+                response = session.get(url, params=params, auth=api_auth(url),
+                    headers=ResponseCache.conditional_headers(cached))
+        API_REQUESTS.inc(endpoint=name, status=response.status_code)
+        API_BYTES.inc(len(response.content), endpoint=name)
+        record_rate_limit(response)
+        if not (response.status_code == 403 and _rate_limit.get('remaining') == 0):
+            break
+
+    if cache:
+        # a 304 doesn't count against the rate limit
+        cache.record(hit=response.status_code == 304 and cached is not None)
+        if response.status_code == 304 and cached:
+            response = ResponseCache.response(cached, response)
+        elif response.ok:
+            cache.put(url, params, response)
+
+    if not response.ok:
+        print '[github_api] %s: failed with %d' % (path, response.status_code)
+        with _api_report_lock:
+            _failures.append((path, response.status_code))
+
+    return response
+
+def record_rate_limit(response):
+    remaining = response.headers.get('X-RateLimit-Remaining')
+    reset = response.headers.get('X-RateLimit-Reset')
+    if remaining is not None and reset is not None:
+        with _api_report_lock:
+            _rate_limit.update(remaining=int(remaining), reset=int(reset))
+        API_RATE_LIMIT_REMAINING.set(int(remaining))
+
+def wait_for_rate_limit():
+    remaining, reset = _rate_limit.get('remaining'), _rate_limit.get('reset')
+    if remaining is None or remaining > config.GITHUB_RATE_LIMIT_THRESHOLD:
+        return
+
+    delay = max(reset - time.time(), 0) + 1
+    print '[github_api] %d requests left, waiting %ds for the rate limit to reset' % (remaining, delay)
+    with _api_report_lock:
+        _throttled.append(delay)
+    time.sleep(delay)
+
+    with _api_report_lock:
+        # let the other threads through until a response tells us otherwise
+        if _rate_limit.get('reset') == reset:
+            _rate_limit.pop('remaining', None)
+
+def api_report():
+    cache = response_cache()
+    with _api_report_lock:
+        return {
+            'rate_limit_remaining': _rate_limit.get('remaining'),
+            'throttled'           : len(_throttled),
+            'throttled_seconds'   : sum(_throttled),
+            'failures'            : list(_failures),
+            'cache_hits'          : cache.hits if cache else 0,
+            'cache_misses'        : cache.misses if cache else 0,
+        }
+
+def reset_api_report():
+    cache = response_cache()
+    with _api_report_lock:
+        del _throttled[:]
+        del _failures[:]
+    if cache:
+        with cache.lock:
+            cache.hits = cache.misses = 0
+
+def github_api_pages(path, params=None):
+    """Yields each page of a listing, following its Link: rel="next" headers"""
+    params = dict(params or {}, per_page=config.GITHUB_PER_PAGE)
+    while path:
+        response = github_api(path, params=params)
+        if not response.ok:
+            return
+        yield json.loads(response.content)
+
+        # the next url carries the query string along
+        path, params = response.links.get('next', {}).get('url'), None
+
+def fetch_all(function, items):
+    """map() over a pool of config.GITHUB_CONCURRENCY threads, the results
+    come back in the order of items"""
+    items = list(items)
+    if config.GITHUB_CONCURRENCY <= 1 or len(items) <= 1:
+        return map(function, items)
+
+    pool = ThreadPool(min(config.GITHUB_CONCURRENCY, len(items)))
+    try:
+        return pool.map(function, items)
+    finally:
+        pool.close()
+
+def iter_pull_requests(user, repository, state='closed'):
+    return github_api_pages('/repos/%(user)s/%(repository)s/pulls' % {'user': user, 'repository': repository}, params={'state': state})
 
 def pull_requests(user, repository, state='closed'):
+    return list(chain.from_iterable(iter_pull_requests(user, repository, state=state)))
+
+def pull_requests_updated_since(user, repository, since=None):
+    """Open and closed pull requests updated at or after since (an ISO 8601
+    timestamp), reading only as many pages as that takes"""
     pulls = []
+    for page in github_api_pages('/repos/%(user)s/%(repository)s/pulls' % {'user': user, 'repository': repository},
+            params={'state': 'all', 'sort': 'updated', 'direction': 'desc'}):
+        pulls += [pull for pull in page if since is None or pull['updated_at'] >= since]
+        if since is not None and page and page[-1]['updated_at'] < since:
+            break
+    return pulls
 
-    response = github_api('/repos/%(user)s/%(repository)s/pulls' % {'user': user, 'repository': repository}, data={'state':state})
+def comment_pull_number(comment):
+    return int(comment['pull_request_url'].rsplit('/', 1)[1])
 
-    if response.ok:
-        pulls = json.loads(response.content)
+def iter_pull_request_comments(user, repository, pull_request_number):
+    return github_api_pages('/repos/%(user)s/%(repository)s/pulls/%(pull_request_number)s/comments' % dict(user=user, repository=repository, pull_request_number=pull_request_number))
 
-    return pulls
+def pull_request_comments(user, repository, pull_request_number):
+    return list(chain.from_iterable(iter_pull_request_comments(user, repository, pull_request_number)))
 
-def pull_requests_with_comments(user, repository, state='closed'):
-    pulls = []
+def iter_repository_comments(user, repository, since=None):
+    """Review comments on every pull request in the repository, a page at a
+    time, optionally only those updated at or after since"""
+    params = {'since': since} if since else None
+    return github_api_pages('/repos/%(user)s/%(repository)s/pulls/comments' % {'user': user, 'repository': repository}, params=params)
+
+def repository_comments(user, repository, since=None):
+    return list(chain.from_iterable(iter_repository_comments(user, repository, since=since)))
+
+def comments_by_pull(comments):
+    grouped = {}
+    for comment in comments:
+        grouped.setdefault(comment_pull_number(comment), []).append(comment)
+    return grouped
+
+def comments_on(pulls, grouped):
     comments = []
+    for pull_request in pulls:
+        comments += grouped.get(pull_request['number'], [])
+    return comments
 
-    pulls = pull_requests(user, repository, state=state)
+def pull_requests_comments(user, repository, pulls):
+    """The comments on pulls, in the order of pulls. With
+    config.GITHUB_BULK_COMMENTS these come from the repository's comment
+    listing rather than a request per pull"""
+    if config.GITHUB_BULK_COMMENTS:
+        return comments_on(pulls, comments_by_pull(repository_comments(user, repository)))
 
-    if pulls:
-        for pull_request in pulls:
-            response = github_api('/repos/%(user)s/%(repository)s/pulls/%(pull_request_number)s/comments' % dict(user=user, repository=repository, pull_request_number=pull_request['number']))
-            if response.ok:
-                comments += json.loads(response.content)
+    comments = []
+    for pull_comments in fetch_all(lambda pull_request: pull_request_comments(user, repository, pull_request['number']), pulls):
+        comments += pull_comments
+    return comments
 
-    return pulls, comments
+def iter_pull_requests_with_comments(user, repository, state='closed'):
+    """Yields (pulls, comments) for each page of pull requests"""
+    grouped = None
+    for pulls in iter_pull_requests(user, repository, state=state):
+        if not config.GITHUB_BULK_COMMENTS:
+            yield pulls, pull_requests_comments(user, repository, pulls)
+            continue
 
-def organisation_repositories(organisation):
-    repositories = []
+        # one listing of the repository's comments serves every page
+        if grouped is None:
+            grouped = comments_by_pull(repository_comments(user, repository))
+        yield pulls, comments_on(pulls, grouped)
 
-    response = github_api('/orgs/%(organisation)s/repos' % {'organisation': organisation})
+def pull_requests_with_comments(user, repository, state='closed'):
+    pulls = []
+    comments = []
 
-    if response.ok:
-        repositories = [repository for repository in json.loads(response.content) if not repository['fork']]
+    for page_pulls, page_comments in iter_pull_requests_with_comments(user, repository, state=state):
+        pulls += page_pulls
+        comments += page_comments
+
+    return pulls, comments
 
-    return repositories
+def iter_organisation_repositories(organisation):
+    for repositories in github_api_pages('/orgs/%(organisation)s/repos' % {'organisation': organisation}):
+        yield [repository for repository in repositories if not repository['fork']]
+
+def organisation_repositories(organisation):
+    return list(chain.from_iterable(iter_organisation_repositories(organisation)))
 
 def organisation(org):
     organisation = None
@@ -0,0 +1,103 @@
+import os
+import threading
+from hashlib import sha1
+from urllib import urlencode
+import requests
+import omnijson as json
+
+class ResponseCache(object):
+    """ On-disk cache of github api responses, for conditional requests.
+
+    Each response with an ETag or Last-Modified header is kept in its own
+    file, keyed by url and query parameters. conditional_headers() turns a
+    cached entry into If-None-Match/If-Modified-Since headers and response()
+    rebuilds the cached response when github answers 304 Not Modified.
+
+    Once the files grow past max_bytes the least recently used are evicted.
+
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.size = sum(os.path.getsize(path) for path in self.paths())
+
+    def paths(self):
+        return [os.path.join(self.directory, name) for name in os.listdir(self.directory) if not name.endswith('.tmp')]
+
+    def path(self, url, params=None):
+        key = url + '?' + urlencode(sorted((params or {}).items()))
+        return os.path.join(self.directory, sha1(key).hexdigest())
+
+    def get(self, url, params=None):
+        path = self.path(url, params)
+        try:
+            with open(path, 'rb') as f:
+                entry = json.loads(f.read())
+            os.utime(path, None)    # most recently used
+        except (IOError, OSError, ValueError):
+            return None
+        return entry
+
+    def put(self, url, params, response):
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if not (etag or last_modified):
+            return
+
+        entry = json.dumps({
+            'etag'         : etag,
+            'last_modified': last_modified,
+            'link'         : response.headers.get('Link'),
+            'content'      : response.content,
+        })
+        path = self.path(url, params)
+        with self.lock:
+            previous = os.path.getsize(path) if os.path.exists(path) else 0
+            with open(path + '.tmp', 'wb') as f:
+                f.write(entry)
+            os.rename(path + '.tmp', path)
+            self.size += len(entry) - previous
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        # least recently used first, down to three quarters of the budget
+        for path in sorted(self.paths(), key=os.path.getmtime):
+            if self.size <= self.max_bytes * 3 / 4:
+                break
+            self.size -= os.path.getsize(path)
+            os.remove(path)
+
+    def record(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    @staticmethod
+    def conditional_headers(entry):
+        headers = {}
+        if entry and entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        elif entry and entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    @staticmethod
+    def response(entry, not_modified):
+        """A 200 response carrying the cached body, with not_modified's headers"""
+        response = requests.Response()
+        response.status_code = 200
+        response.headers.update(not_modified.headers)
+        if entry['link']:
+            response.headers['Link'] = entry['link']
+        response._content = entry['content'].encode('utf-8')
+        response.url = not_modified.url
+        return response
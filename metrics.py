@@ -0,0 +1,173 @@
+""" In-process counters, gauges and histograms, rendered in the Prometheus
+text format for the /metrics page.
+
+Metrics are declared once, at import, by the module they measure:
+
+    PARSE_SECONDS = metrics.Histogram('inquisition_store_parse_seconds',
+        'Time parsing store files', ['file'])
+
+    with PARSE_SECONDS.time(file='store'):
+        ...
+
+Updating one takes a lock and a dict update, cheap enough to leave on.
+Each process has its own. The web workers save theirs with write_state()
+every so often, and /metrics renders their merge(), so a scrape sees the
+whole server whichever worker answers it. The refresher saves its state
+after each refresh, rendered alongside with a process="refresh" label.
+
+"""
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+import omnijson as json
+
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300)
+
+_lock = threading.Lock()
+_metrics = []
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}     # label values -> value
+        _metrics.append(self)
+
+    def key(self, labels):
+        return tuple(unicode(labels[label]) for label in self.labels)
+
+    def samples(self, key, value, extra_labels):
+        return [(self.name, self.labels, key, extra_labels, value)]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with _lock:
+            self.values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        bucket = bisect_left(self.buckets, value)
+        with _lock:
+            # [count per bucket (the last is +Inf), sum]
+            observed = self.values.get(key)
+            if observed is None:
+                observed = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            observed[0][bucket] += 1
+            observed[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - started, **labels)
+
+    def samples(self, key, value, extra_labels):
+        counts, total = value
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += count
+            samples.append((self.name + '_bucket', self.labels + ('le',), key + (unicode(bound),), extra_labels, cumulative))
+        samples.append((self.name + '_sum', self.labels, key, extra_labels, total))
+        samples.append((self.name + '_count', self.labels, key, extra_labels, cumulative))
+        return samples
+
+
+def state():
+    """Every metric's values, as json-able {name: [[label values, value]]}"""
+    with _lock:
+        return dict((metric.name, [[list(key), value] for key, value in metric.values.items()]) for metric in _metrics)
+
+def write_state(path, values=None):
+    """Writes values (this process's state by default) aside and renames it
+    into place"""
+    with open(path + '.tmp', 'w') as f:
+        f.write(json.dumps(state() if values is None else values))
+    os.rename(path + '.tmp', path)
+
+def read_state(path):
+    try:
+        with open(path) as f:
+            return json.loads(f.read())
+    except (IOError, ValueError):
+        return None
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_sample(name, labels, key, extra_labels, value):
+    pairs = zip(labels, key) + sorted(extra_labels.items())
+    labels = '{%s}' % ','.join('%s="%s"' % (label, escape(value)) for label, value in pairs) if pairs else ''
+    return '%s%s %s' % (name, labels, repr(float(value)) if isinstance(value, float) else value)
+
+def merge(states):
+    """One state of several processes': counters and histograms summed, the
+    last of each gauge"""
+    kinds = dict((metric.name, metric.kind) for metric in _metrics)
+    merged = {}
+    for state in states:
+        for name, values in (state or {}).iteritems():
+            into = merged.setdefault(name, {})
+            for key, value in values:
+                key = tuple(key)
+                if key not in into or kinds.get(name) == 'gauge':
+                    into[key] = value
+                elif kinds.get(name) == 'histogram':
+                    counts, total = into[key]
+                    into[key] = [[a + b for a, b in zip(counts, value[0])], total + value[1]]
+                else:
+                    into[key] = into[key] + value
+    return dict((name, [[list(key), value] for key, value in values.iteritems()]) for name, values in merged.iteritems())
+
+def cumulative(state):
+    """The counters and histograms of a state, which still add up after the
+    process is gone, without its gauges"""
+    kinds = dict((metric.name, metric.kind) for metric in _metrics)
+    return dict((name, values) for name, values in (state or {}).iteritems() if kinds.get(name) != 'gauge')
+
+def render(own=None, others=()):
+    """The Prometheus text format of own (a state, this process's by
+    default) and of the states in others, a list of ({label: value}, state)
+    to tell them apart"""
+    own = state() if own is None else own
+    lines = []
+    for metric in _metrics:
+        samples = []
+        for key, value in sorted(own.get(metric.name, [])):
+            samples += metric.samples(tuple(key), value, {})
+        for extra_labels, other in others:
+            for key, value in (other or {}).get(metric.name, []):
+                samples += metric.samples(tuple(key), value, extra_labels)
+        if not samples:
+            continue
+        lines.append('# HELP %s %s' % (metric.name, metric.help))
+        lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+        lines += [format_sample(*sample) for sample in samples]
+    return u'\n'.join(lines) + u'\n'
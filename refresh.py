@@ -0,0 +1,91 @@
+""" Keeps the store up to date, in place of a cron job.
+
+    $ python refresh.py           # refresh every REFRESH_INTERVAL seconds
+    $ python refresh.py --once    # refresh now and exit
+    $ python refresh.py --full    # fetch everything, not just the changes
+
+Only one refresh of an organisation runs at a time, whichever process (or
+web worker, with REFRESH_IN_WORKERS) starts it: the others skip their turn.
+The store, aggregate and snapshot files are each written aside and renamed
+into place, so the web workers switch to the new snapshot on their next
+look, without a restart. The web workers never write them: a snapshot that
+is missing, behind the store or from an older version is rebuilt here.
+
+"""
+import os
+import random
+import time
+from argparse import ArgumentParser
+import store
+import metrics
+import config
+
+def metrics_path(organisation):
+    return '%s/%s.metrics.json' % (config.STORE, organisation)
+
+def data_age(organisation):
+    """Seconds since the served snapshot was published, None before the first"""
+    path = store.snapshot_path(organisation)
+    return time.time() - os.path.getmtime(path) if os.path.exists(path) else None
+
+def refresh(organisation, incremental=True):
+    """Refreshes the store unless another refresh holds the lock, returning
+    whether it ran"""
+    with store.refresh_lock(organisation) as locked:
+        if not locked:
+            print '[refresh] %s: another refresh is running, skipping' % organisation
+            return False
+        started = time.time()
+        try:
+            store.load_data(organisation, update=True, incremental=incremental and os.path.exists(store.store_path(organisation)))
+        finally:
+            # for the web workers' /metrics
+            metrics.write_state(metrics_path(organisation))
+        print '[refresh] %s: published in %.1fs' % (organisation, time.time() - started)
+        return True
+
+def rebuild(organisation):
+    """Rewrites a stale snapshot (see store.stale_snapshot) from the store,
+    without fetching, unless another refresh holds the lock. Returns
+    whether it ran."""
+    with store.refresh_lock(organisation) as locked:
+        if not locked or not store.stale_snapshot(organisation):
+            return False
+        store.write_aggregate(organisation, store.load_data(organisation))
+        print '[refresh] %s: rebuilt the snapshot from the store' % organisation
+        return True
+
+def next_refresh(interval=None, jitter=None):
+    """Seconds until the next refresh, spread by up to jitter so the
+    refreshers of several organisations don't hit github together"""
+    interval = config.REFRESH_INTERVAL if interval is None else interval
+    jitter = config.REFRESH_JITTER if jitter is None else jitter
+    return interval + random.uniform(0, jitter)
+
+def run(organisation, incremental=True):
+    """Refreshes every REFRESH_INTERVAL seconds, until interrupted"""
+    while True:
+        age = data_age(organisation)
+        try:
+            # several web workers may each be running this, after one of
+            # them refreshes the others find the data fresh
+            if age is None or age >= config.REFRESH_INTERVAL:
+                refresh(organisation, incremental)
+            else:
+                rebuild(organisation)
+        except Exception, e:
+            age = data_age(organisation)
+            print '[refresh] %s: failed (%s), serving %s' % (
+                organisation, e, 'data %ds old' % age if age is not None else 'no data yet')
+        time.sleep(next_refresh())
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Refresh the github data store')
+    parser.add_argument('--once', action='store_true', help='refresh now and exit')
+    parser.add_argument('--full', action='store_true', help='fetch everything, not just the changes')
+    args = parser.parse_args()
+
+    if args.once:
+        refresh(config.ORGANISATION_NAME, incremental=not args.full)
+    else:
+        run(config.ORGANISATION_NAME, incremental=not args.full)
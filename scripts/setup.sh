@@ -52,6 +52,14 @@ user=nobody
 autostart=true
 autorestart=true
 redirect_stderr=True
+
+[program:inquisition-refresh]
+command=$INQUISITION_ROOT/bin/python refresh.py
+directory=$INQUISITION_ROOT
+user=nobody
+autostart=true
+autorestart=true
+redirect_stderr=True
 EOF
 
 # Restart the things
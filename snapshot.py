@@ -0,0 +1,137 @@
+""" Read-only, memory-mapped snapshots of the serving data.
+
+A snapshot file is written once, after each refresh, and mapped by every
+web worker. Each worker parses only the small index up front. The records
+it looks up are decoded from the shared pages on access, so the data itself
+is held once, in the OS page cache, however many workers there are.
+
+Layout: the magic, the offset and length of the index, then the json blobs
+and finally the json index. A section of the index is either the [offset,
+length] of one blob, or {'keys': {key: node}} for a dict split into a blob
+per key (split to the depth given to write()).
+
+"""
+import mmap
+import os
+import struct
+import omnijson as json
+
+MAGIC = 'INQSNAP1'
+HEADER = struct.Struct('<QQ')
+
+def write(path, data, split=None):
+    """Writes data (a dict of sections) to path, splitting split[section]
+    levels of dicts into a blob per key. The file is replaced atomically."""
+    split = split or {}
+    tempname = path + '.tmp'
+    with open(tempname, 'wb') as f:
+        f.write(MAGIC + '\0' * HEADER.size)
+        index = dict((key, _write_node(f, value, split.get(key, 0))) for key, value in data.iteritems())
+        index_offset = f.tell()
+        index = _encode(index)
+        f.write(index)
+        f.seek(len(MAGIC))
+        f.write(HEADER.pack(index_offset, len(index)))
+    os.rename(tempname, path)
+
+def _encode(value):
+    blob = json.dumps(value)
+    if isinstance(blob, unicode):
+        blob = blob.encode('utf-8')
+    return blob
+
+def _write_node(f, value, depth):
+    if depth and isinstance(value, dict):
+        return {'keys': dict((key, _write_node(f, item, depth - 1)) for key, item in value.iteritems())}
+    blob = _encode(value)
+    offset = f.tell()
+    f.write(blob)
+    return [offset, len(blob)]
+
+
+class Snapshot(object):
+    """ A snapshot file mapped read-only, used like the dict it was written
+    from. Whole sections are decoded once and kept, split sections come back
+    as SnapshotDicts that decode a key's record on each lookup.
+
+    """
+
+    def __init__(self, fileobj):
+        self._map = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            raise ValueError('Not a snapshot: %s' % fileobj.name)
+        index_offset, index_length = HEADER.unpack_from(self._map, len(MAGIC))
+        self._index = json.loads(self._map[index_offset:index_offset + index_length])
+        self._sections = {}
+
+    def load(self, node):
+        if isinstance(node, dict):
+            return SnapshotDict(self, node['keys'])
+        offset, length = node
+        return json.loads(self._map[offset:offset + length])
+
+    def __getitem__(self, key):
+        if key not in self._sections:
+            self._sections[key] = self.load(self._index[key])
+        return self._sections[key]
+
+    def get(self, key, default=None):
+        return self[key] if key in self._index else default
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def keys(self):
+        return self._index.keys()
+
+
+class SnapshotDict(object):
+    """ A read-only dict over a split section of a snapshot """
+    __slots__ = ('_snapshot', '_index')
+
+    def __init__(self, snapshot, index):
+        self._snapshot = snapshot
+        self._index = index
+
+    def __getitem__(self, key):
+        return self._snapshot.load(self._index[key])
+
+    def get(self, key, default=None):
+        return self[key] if key in self._index else default
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def keys(self):
+        return self._index.keys()
+
+    def iteritems(self):
+        for key in self._index:
+            yield key, self[key]
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return [value for key, value in self.iteritems()]
+
+    def __eq__(self, other):
+        return dict(self.iteritems()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, dict(self.iteritems()))
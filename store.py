@@ -1,45 +1,239 @@
 import os
+import calendar
+import fcntl
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 import github
+from itertools import chain
 from counter import Counter
 from operator import itemgetter
-from dictionaries import DotDict, PersistentDict
+from dictionaries import DotDictView, PersistentDict
+from snapshot import Snapshot
+import snapshot
+import metrics
 import omnijson as json
 import config
 
-def load_data(organisation_name, update=False):
+# parsed store files, shared by every caller in this process:
+# path -> (version, data). Snapshots are handed out as-is, so callers must
+# treat them as read-only.
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+PARSE_SECONDS = metrics.Histogram('inquisition_store_parse_seconds', 'Time parsing (or mapping) a store file', ['file'])
+LOAD_SECONDS = metrics.Histogram('inquisition_load_data_seconds', 'Time fetching and writing the store', ['mode'],
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200))
+AGGREGATE_SECONDS = metrics.Histogram('inquisition_aggregate_seconds', 'Time counting the aggregate', ['mode'])
+
+def file_kind(path):
+    if path.endswith('.snapshot'):
+        return 'snapshot'
+    return 'aggregate' if path.endswith('.aggregate.json') else 'store'
+
+def store_path(organisation_name):
+    return '%s/%s.json' % (config.STORE, organisation_name)
+
+def file_version(stat):
+    return (stat.st_mtime, stat.st_size, stat.st_ino)
+
+def store_version(path):
+    try:
+        return file_version(os.stat(path))
+    except OSError:
+        return None
+
+def read_snapshot(path, build=None, load=None):
+    """The parsed file at path, passed through build() when given. load(f)
+    replaces parsing the file as json."""
+    version = store_version(path)
+    cached = _snapshots.get(path)
+    if cached and cached[0] == version:
+        return cached[1]
+
+    with _snapshots_lock:
+        cached = _snapshots.get(path)
+        if cached and cached[0] == version:
+            return cached[1]
+        with PARSE_SECONDS.time(file=file_kind(path)):
+            with open(path, 'rb') as f:
+                # version the bytes we actually parse, the file may have been
+                # replaced since the stat above
+                version = file_version(os.fstat(f.fileno()))
+                data = load(f) if load else json.loads(f.read())
+            if build:
+                data = build(data)
+        _snapshots[path] = (version, data)
+        return data
+
+# the store keeps each pull request and comment once, keyed by id, with
+# per-project lists of ids. load_data hands out the list views below, built
+# from references to those records.
+VIEWS = {
+    'pull_requests_per_project'        : ('pull_request_records', 'pull_request_ids_per_project'),
+    'pull_request_comments_per_project': ('pull_request_comment_records', 'pull_request_comment_ids_per_project'),
+}
+
+def normalise(data):
+    stored = dict((key, value) for key, value in data.items()
+        if key not in VIEWS and key not in ('pull_requests', 'pull_request_comments'))
+    for view, (records_key, ids_key) in VIEWS.items():
+        records = stored[records_key] = {}
+        ids_per_project = stored[ids_key] = {}
+        for project, items in data[view].items():
+            ids = ids_per_project[project] = []
+            for item in items:
+                records[str(item['id'])] = item
+                ids.append(str(item['id']))
+    return stored
+
+def denormalise(stored):
+    if 'pull_request_records' not in stored:
+        # written before the store was normalised
+        return stored
+
+    data = dict(stored)
+    for view, (records_key, ids_key) in VIEWS.items():
+        records = data.pop(records_key)
+        data[view] = dict((project, [records[id] for id in ids]) for project, ids in data.pop(ids_key).items())
+
+    data['pull_requests'] = list(chain.from_iterable(data['pull_requests_per_project'].get(project, []) for project in data['projects']))
+    data['pull_request_comments'] = list(chain.from_iterable(data['pull_request_comments_per_project'].get(project, []) for project in data['projects']))
+    return data
+
+# a run of load_data checkpoints each project it finishes, and the user
+# profiles in batches of USER_CHECKPOINT_BATCH, to STORE/<org>.checkpoints.
+# A rerun after a crash resumes from them, as long as it's the same kind of
+# run over the same store.
+USER_CHECKPOINT_BATCH = 100
+
+def checkpoint_path(organisation_name):
+    return '%s/%s.checkpoints' % (config.STORE, organisation_name)
+
+def open_checkpoints(organisation_name, run):
+    """The checkpoint directory for run, cleared of any other run's"""
+    directory = checkpoint_path(organisation_name)
+    if read_checkpoint(directory, 'run') != run:
+        if os.path.isdir(directory):
+            shutil.rmtree(directory)
+        os.makedirs(directory)
+        write_checkpoint(directory, 'run', run)
+    return directory
+
+def read_checkpoint(directory, name):
+    try:
+        with open(os.path.join(directory, name + '.json'), 'rb') as f:
+            return json.loads(f.read())
+    except (IOError, ValueError):
+        return None
+
+def write_checkpoint(directory, name, value):
+    path = os.path.join(directory, name + '.json')
+    with open(path + '.tmp', 'wb') as f:
+        f.write(json.dumps(value))
+    os.rename(path + '.tmp', path)
+
+def projected(item, fields):
+    # None (github's deleted users) and unprojected fields are passed through
+    return github.extract(item, fields) if fields and item else item
+
+def load_data(organisation_name, update=False, incremental=False):
     data = {}
-    path = '%s/%s.json' % (config.STORE, organisation_name)
+    path = store_path(organisation_name)
     if os.path.exists(path) and not update:
-        with open(path, 'rb') as f:
-            data = json.loads(f.read())
+        data = read_snapshot(path, denormalise)
     else:
-        organisation = github.organisation(organisation_name)
-        projects = [repository['name'] for repository in github.organisation_repositories(organisation_name)]
+        started = time.time()
+        # an incremental update only fetches what changed since the last one
+        previous = read_snapshot(path, denormalise) if incremental and os.path.exists(path) else {}
+        sync_state = dict(previous.get('sync_state', {}))
+
+        github.reset_api_report()
+        organisation = projected(github.organisation(organisation_name), config.ORGANISATION_FIELDS)
+        repositories = github.organisation_repositories(organisation_name)
+        projects = [repository['name'] for repository in repositories]
+        repositories = dict(zip(projects, repositories))
         pull_request_map = {}
         pull_request_comments_map = {}
         pull_requests = []
         pull_request_comments = []
         projects_with_pulls = []
-        user_data = {}
-        project_data = {}
+        user_data = dict(previous.get('user_data', {}))
+        project_data = dict(previous.get('project_data', {}))
+
+        run = {'incremental': bool(previous), 'store': list(store_version(path)) if previous else None}
+        checkpoints = open_checkpoints(organisation_name, run)
+        user_data.update(read_checkpoint(checkpoints, 'users') or {})
+
+        def fetch_project_checkpointed(project):
+            name = 'project-%s' % project
+            checkpoint = read_checkpoint(checkpoints, name)
+            if checkpoint:
+                print '[load_data] %s: resumed from checkpoint' % project
+                return checkpoint['pulls'], checkpoint['comments'], checkpoint['changed']
+
+            pulls, comments, changed = fetch_project(project)
+            # a project missing pages is fetched again next time
+            if not failed(project):
+                write_checkpoint(checkpoints, name, {'pulls': pulls, 'comments': comments, 'changed': changed})
+            return pulls, comments, changed
+
+        def failed(project):
+            """Whether any of this run's requests for the project failed"""
+            prefix = '/repos/%s/%s/' % (organisation_name, project)
+            return any(prefix in failure[0] for failure in github.api_report()['failures'])
+
+        def fetch_project(project):
+            if project in sync_state:
+                return fetch_project_changes(project)
+
+            pulls = github.pull_requests(organisation_name, project, state='closed')
+            open_pulls = github.pull_requests(organisation_name, project, state='open')
+            comments = github.pull_requests_comments(organisation_name, project, pulls + open_pulls)
+            print '[load_data] %s: got %d pull requests (%d open) with %d comments' % (project, len(pulls + open_pulls), len(open_pulls), len(comments))
+            return projected_pulls(pulls + open_pulls), projected_comments(comments), True
+
+        def projected_pulls(pulls):
+            return [projected(pull, config.PULL_REQUEST_FIELDS) for pull in pulls]
 
-        for project in projects:
-            pulls, comments = github.pull_requests_with_comments(organisation_name, project, state='closed')
-            print '[load_data] %s: got %d pull requests with %d comments' % (project, len(pulls), len(comments))
-            open_pulls, open_comments = github.pull_requests_with_comments(organisation_name, project, state='open')
-            print '[load_data] %s: got %d open pull requests with %d comments' % (project, len(open_pulls), len(open_comments))
+        def projected_comments(comments):
+            return [projected(comment, config.COMMENT_FIELDS) for comment in comments]
 
-            for user in [x['user']['login'] for x in pulls+open_pulls if x['user']]:
+        def fetch_project_changes(project):
+            since = sync_state[project]
+            updated_pulls = github.pull_requests_updated_since(organisation_name, project, since)
+            if config.GITHUB_BULK_COMMENTS:
+                # just the comments updated since, on any pull
+                updated_comments = github.repository_comments(organisation_name, project, since=since)
+            else:
+                updated_comments = github.pull_requests_comments(organisation_name, project, updated_pulls)
+            print '[load_data] %s: got %d pull requests and %d comments updated since %s' % (project, len(updated_pulls), len(updated_comments), since)
+
+            previous_pulls = previous['pull_requests_per_project'].get(project, [])
+            previous_comments = previous['pull_request_comments_per_project'].get(project, [])
+            pulls, comments = merge_pulls(previous_pulls, previous_comments,
+                projected_pulls(updated_pulls), projected_comments(updated_comments), all_comments=not config.GITHUB_BULK_COMMENTS)
+            # since is inclusive, so the newest records always come back: only
+            # a project whose records actually differ counts as changed
+            return pulls, comments, (pulls, comments) != (previous_pulls, previous_comments)
+
+        logins = []
+        changed_projects = set()
+        for project, (pulls, comments, changed) in zip(projects, github.fetch_all(fetch_project_checkpointed, projects)):
+            if changed:
+                changed_projects.add(project)
+
+            for user in [x['user']['login'] for x in pulls if x['user']]:
                 if user not in user_data:
                     print '[load_data] %s: caching user %s' % (project, user)
-                    user_data[user] = github.user(user)
+                    user_data[user] = None
+                    logins.append(user)
 
-            if project not in project_data and (pulls+open_pulls):
+            if project not in project_data and pulls:
                 print '[load_data] caching project %s data' % project
-                project_data[project] = (pulls or open_pulls)[0]['base']['repo'] 
-
-            pulls += open_pulls
-            comments += open_comments
+                project_data[project] = projected(repositories[project], config.PROJECT_FIELDS)
 
             pull_request_map[project] = pulls
             pull_request_comments_map[project] = comments
@@ -49,6 +243,28 @@ def load_data(organisation_name, update=False):
 
             if pulls:
                 projects_with_pulls.append(project)
+                if not failed(project):
+                    sync_state[project] = max(pull['updated_at'] for pull in pulls)
+                else:
+                    # the pulls on the pages that failed are older than the
+                    # newest we got: keep the last cursor (or none, for a
+                    # full fetch) so the next run asks for them again
+                    print '[load_data] %s: incomplete, it will be fetched from %s again' % (project, sync_state.get(project, 'scratch'))
+
+        fetched_users = {}
+        for start in range(0, len(logins), USER_CHECKPOINT_BATCH):
+            batch = logins[start:start + USER_CHECKPOINT_BATCH]
+            fetched_users.update(zip(batch, github.fetch_all(lambda login: projected(github.user(login), config.USER_FIELDS), batch)))
+            write_checkpoint(checkpoints, 'users', dict((login, profile) for login, profile in fetched_users.items() if profile))
+        user_data.update(fetched_users)
+
+        report = github.api_report()
+        if report['cache_hits'] or report['cache_misses']:
+            print '[load_data] %d github responses unchanged, %d fetched' % (report['cache_hits'], report['cache_misses'])
+        if report['throttled']:
+            print '[load_data] waited %ds for the github rate limit %d times' % (report['throttled_seconds'], report['throttled'])
+        if report['failures']:
+            print '[load_data] WARNING: %d github requests failed, %s is incomplete' % (len(report['failures']), path)
 
         data = {
             'pull_requests'                    : pull_requests,
@@ -63,77 +279,334 @@ def load_data(organisation_name, update=False):
 
             'user_data'                        : user_data,
             'project_data'                     : project_data,
+
+            # the newest pull request updated_at we've seen, per project
+            'sync_state'                       : sync_state,
         }
-        with PersistentDict(path, 'c', format='json') as d:
-            d.update(data)
+        with PersistentDict(path, 'n', format='json') as d:
+            d.update(normalise(data))
+        with _snapshots_lock:
+            _snapshots[path] = (store_version(path), data)
+        # an incremental update only recounts the projects that changed
+        write_aggregate(organisation_name, data, changed=changed_projects if previous else None)
+        shutil.rmtree(checkpoints)
+        LOAD_SECONDS.observe(time.time() - started, mode='incremental' if previous else 'full')
 
     return data
 
-def open_pull_requests(organisation):
-    data = load_data(organisation)
-    return [pull for pull in data['pull_requests'] if pull['state']=='open']
+def merge_pulls(pulls, comments, updated_pulls, updated_comments, all_comments=True):
+    """Replaces the pulls that were updated, adding new ones after the
+    existing pulls. With all_comments, updated_comments are every comment on
+    the updated pulls and replace their old ones, otherwise they're merged
+    in by comment id."""
+    updated = dict((pull['number'], pull) for pull in updated_pulls)
+
+    merged_pulls = [updated.pop(pull['number'], pull) for pull in pulls]
+    merged_pulls += [pull for pull in updated_pulls if pull['number'] in updated]
+
+    if all_comments:
+        updated_numbers = set(pull['number'] for pull in updated_pulls)
+        merged_comments = [comment for comment in comments if github.comment_pull_number(comment) not in updated_numbers]
+        merged_comments += updated_comments
+    else:
+        updated = dict((comment['id'], comment) for comment in updated_comments)
+        merged_comments = [updated.pop(comment['id'], comment) for comment in comments]
+        merged_comments += [comment for comment in updated_comments if comment['id'] in updated]
+
+    return merged_pulls, merged_comments
+
+def open_pull_requests(organisation, projects=None, offset=0, limit=None):
+    """The open pull requests of projects (all of them by default), by
+    project and then newest first. Only the projects with pulls between
+    offset and offset + limit are decoded."""
+    data = aggregate_data(organisation)
+    counts = data['open_pull_counts']
+    pulls = []
+    skipped = position = 0
+    for project in sorted(counts if projects is None else set(projects)):
+        count = counts.get(project, 0)
+        if count and position + count > offset and (limit is None or position < offset + limit):
+            if not pulls:
+                skipped = position
+            pulls += data['open_pulls'][project]
+        position += count
+    start = offset - skipped
+    return pulls[start:] if limit is None else pulls[start:start + limit]
+
+def open_pulls_index(data, previous=None, changed=None):
+    """{project: open pull requests, newest first}, keeping the previous
+    aggregate's lists for the projects that haven't changed"""
+    reuse = previous is not None and changed is not None and isinstance(previous.get('open_pulls'), dict)
+    index = {}
+    for project in data['projects_with_pulls']:
+        if reuse and project not in changed:
+            pulls = previous['open_pulls'].get(project)
+        else:
+            pulls = sorted((pull for pull in data['pull_requests_per_project'][project] if pull['state'] == 'open'),
+                key=itemgetter('created_at'), reverse=True)
+        if pulls:
+            index[project] = pulls
+    return index
+
+def leaderboard(counts, n=None):
+    if n is not None:
+        return [{'login':key, 'count':value} for key, value in Counter(counts).most_common(n)]
+    items = [{'login':key, 'count':value} for key, value in counts.iteritems()]
+    return sorted(items, key=itemgetter('count'), reverse=True)
 
 def count_per_user(items, count_key=None):
-    items = [{'login':key, 'count':value} for key, value in Counter([x.get('user', {}).get('login') for x in items if x['user']]).items()]
-    aggregate = sorted(items, key=itemgetter('count'), reverse=True)
-    return aggregate
+    return leaderboard(Counter([x.get('user', {}).get('login') for x in items if x['user']]))
 
-def aggregate_data(organisation):
-    data = load_data(organisation)
-
-    total_pull_counts = count_per_user(data['pull_requests'])
-    total_comment_counts = count_per_user(data['pull_request_comments'])
-
-    project_counts, user_counts = aggregate_stats(organisation)
-
-    data = {
-        'raw'         : data,
-        'user_avatars': map_user_avatars(organisation),
-        'projects'    : project_counts,
-        'users'       : user_counts,
-        'totals': {
-            'pulls'   : total_pull_counts,
-            'comments': total_comment_counts,
-        },
-        'organisation': data['organisation'],
-    }
-    return data
+KINDS = ('pulls', 'comments')
 
-def map_user_avatars(organisation):
-    data = load_data(organisation)
-    user_avatar_map = {}
-    for item in data['pull_requests'] + data['pull_request_comments']:
-        user_avatar_map[(item['user'] or {}).get('login')] = (item['user'] or {})['avatar_url'] if item['user'] else None
+def count_project(pulls, comments):
+    """Counts one project's pulls and comments per user, and per user per day
+    of creation, with the avatars seen on the way"""
+    counts = {}
+    days = {}
+    avatars = {}
+    for kind, items in (('pulls', pulls), ('comments', comments)):
+        kind_counts = counts[kind] = Counter()
+        kind_days = days[kind] = {}
+        for item in items:
+            user = item['user']
+            if user:
+                kind_counts[user['login']] += 1
+                avatars[user['login']] = user['avatar_url']
+                if item.get('created_at'):
+                    day = kind_days.setdefault(item['created_at'][:10], {})
+                    day[user['login']] = day.get(user['login'], 0) + 1
+    return counts, days, avatars
 
-    return user_avatar_map
+def count_all(data, previous=None, changed=None):
+    """Counts every pull request and comment into per project counters, the
+    single source for the per project and per user tables, the organisation
+    totals, the timeline and the avatar map.
 
-def aggregate_stats(organisation):
-    data = load_data(organisation)
+    Given the previous aggregate and the projects that changed since, only
+    those projects are recounted."""
+    with_pulls = set(data['projects_with_pulls'])
+    # counters['pulls']['supporttools']['michael'] = 5
+    counters = {'pulls': {}, 'comments': {}}
+    # timeline['pulls']['2013-04-01']['supporttools']['michael'] = 2
+    timeline = {'pulls': {}, 'comments': {}}
+    avatars = {}
 
-    project_counts = DotDict({})
-    user_counts = DotDict({})
+    reuse = previous is not None and changed is not None and 'counters' in previous
+    if reuse:
+        avatars.update(previous['user_avatars'])
+        for kind in KINDS:
+            counters[kind] = dict((project, counts) for project, counts in previous['counters'][kind].iteritems()
+                if project in with_pulls and project not in changed)
+            for day, projects in previous['timeline'][kind].iteritems():
+                kept = dict((project, logins) for project, logins in projects.iteritems()
+                    if project in with_pulls and project not in changed)
+                if kept:
+                    timeline[kind][day] = kept
 
     for project in data['projects_with_pulls']:
-        # retrieve pulls for a project
-        project_pulls = data['pull_requests_per_project'][project]
-        comments = data['pull_request_comments_per_project'][project]
+        if reuse and project not in changed:
+            continue
+        counts, days, project_avatars = count_project(
+            data['pull_requests_per_project'][project], data['pull_request_comments_per_project'][project])
+        avatars.update(project_avatars)
+        for kind in KINDS:
+            counters[kind][project] = counts[kind]
+            for day, logins in days[kind].iteritems():
+                timeline[kind].setdefault(day, {})[project] = logins
+
+    project_counts = {}
+    user_counts = {}
+    for kind in KINDS:
+        for project, counts in counters[kind].iteritems():
+            project_stats = project_counts.setdefault(project, {})
+            # project_counts['supporttools']['pulls'] = [{'login': 'michael', 'count': 5}, ...]
+            project_stats[kind] = leaderboard(counts)
+            for login, count in counts.iteritems():
+                # project_counts['supporttools']['michael']['pulls'] = 5
+                project_stats.setdefault(login, {})[kind] = count
+                # user_counts['michael']['supporttools']['pulls'] = 5
+                user_counts.setdefault(login, {}).setdefault(project, {})[kind] = count
+
+    return {
+        'projects': project_counts,
+        'users'   : user_counts,
+        'totals'  : dict((kind, leaderboard(Counter.merge(counters[kind].values()))) for kind in KINDS),
+        'counters': counters,
+        'avatars' : avatars,
+        'timeline': timeline,
+        'months'  : sorted(set(day[:7] for days in timeline.values() for day in days), reverse=True),
+    }
+
+def window_days(days=None, month=None, today=None):
+    """The timeline's day keys for the last days, or for a month ('2013-04')"""
+    if month:
+        year, month = [int(part) for part in month.split('-')]
+        return ['%04d-%02d-%02d' % (year, month, day) for day in range(1, calendar.monthrange(year, month)[1] + 1)]
+    today = today or datetime.utcnow().date()
+    return [(today - timedelta(days=n)).isoformat() for n in range(days)]
+
+def windowed_counts(timeline, days, project=None, login=None):
+    """Sums the day buckets into {project: {login: count}}, optionally for
+    one project or login. The cost depends on the activity in the window,
+    not on the history before it."""
+    counts = {}
+    for day in days:
+        for bucket_project, logins in timeline.get(day, {}).iteritems():
+            if project is not None and bucket_project != project:
+                continue
+            project_counts = counts.setdefault(bucket_project, {})
+            for bucket_login, count in logins.iteritems():
+                if login is None or bucket_login == login:
+                    project_counts[bucket_login] = project_counts.get(bucket_login, 0) + count
+    return counts
+
+def windowed_totals(aggregate, days, n=None):
+    """The pull request and comment leaderboards for the window, the top n
+    picked with a heap"""
+    totals = {}
+    for kind in ('pulls', 'comments'):
+        counts = Counter()
+        for logins in windowed_counts(aggregate['timeline'][kind], days).itervalues():
+            counts.update(logins)
+        totals[kind] = leaderboard(counts, n)
+    return totals
+
+def windowed_user_stats(aggregate, login, days):
+    """{project: {'pulls': count, 'comments': count}} for login in the window"""
+    stats = {}
+    for kind in ('pulls', 'comments'):
+        for project, logins in windowed_counts(aggregate['timeline'][kind], days, login=login).iteritems():
+            if logins:
+                stats.setdefault(project, {})[kind] = logins[login]
+    return stats
 
-        # calculate the pull request leaderboard for this project
-        project_counts['%s.pulls' % project] = count_per_user(project_pulls)
-        project_counts['%s.comments' % project] = count_per_user(comments)
+def windowed_project_stats(aggregate, project, days):
+    """{login: {'pulls': count, 'comments': count}} for project in the window"""
+    stats = {}
+    for kind in ('pulls', 'comments'):
+        for login, count in windowed_counts(aggregate['timeline'][kind], days, project=project).get(project, {}).iteritems():
+            stats.setdefault(login, {})[kind] = count
+    return stats
 
-        # create user/project and project/user keyed transformations
-        for user in project_counts[project]['pulls']:
-            # user_counts['michael']['supporttools']['pulls'] = 5
-            user_counts['%s.%s.pulls' % (user['login'], project)] = user['count']
-            # projects_counts['supporttools']['michael']['pulls'] = 5
-            project_counts['%s.%s.pulls' % (project, user['login'])] = user['count']
+def aggregate_path(organisation_name):
+    return '%s/%s.aggregate.json' % (config.STORE, organisation_name)
 
-        for user in project_counts[project]['comments']:
-            # user_counts['michael']['supporttools']['comments'] = 5
-            user_counts['%s.%s.comments' % (user['login'], project)] = user['count']
-            # project_counts['supporttools']['michael']['comments'] = 5
-            project_counts['%s.%s.comments' % (project, user['login'])] = user['count']
+def snapshot_path(organisation_name):
+    return '%s/%s.snapshot' % (config.STORE, organisation_name)
 
-    return project_counts, user_counts
+def lock_path(organisation_name):
+    return '%s/%s.lock' % (config.STORE, organisation_name)
 
+@contextmanager
+def refresh_lock(organisation_name):
+    """Takes the organisation's refresh lock without waiting, yielding
+    whether we got it. Only the holder should write the store."""
+    with open(lock_path(organisation_name), 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def refreshing(organisation_name):
+    with refresh_lock(organisation_name) as locked:
+        return not locked
+
+# the aggregate sections stored a blob per key in the snapshot (and how many
+# levels deep), so a page decodes just the records it shows
+SNAPSHOT_SPLIT = {
+    'user_avatars': 1,
+    'projects'    : 1,
+    'users'       : 1,
+    'user_data'   : 1,
+    'project_data': 1,
+    'timeline'    : 2,
+    'open_pulls'  : 1,
+}
+
+# bumped when the aggregate's sections change shape, so that an aggregate
+# written by an older version is rebuilt rather than misread
+AGGREGATE_FORMAT = 2
+
+def compute_aggregate(data, previous=None, changed=None):
+    with AGGREGATE_SECONDS.time(mode='incremental' if previous and changed is not None else 'full'):
+        counts = count_all(data, previous, changed)
+        open_pulls = open_pulls_index(data, previous, changed)
+
+    return {
+        'user_avatars' : counts['avatars'],
+        'projects'     : counts['projects'],
+        'users'        : counts['users'],
+        'totals'       : counts['totals'],
+        'counters'     : counts['counters'],
+        'timeline'     : counts['timeline'],
+        'months'       : counts['months'],
+        'organisation' : data['organisation'],
+        'project_names': data['projects'],
+        'user_data'    : data['user_data'],
+        'project_data' : data['project_data'],
+        'open_pulls'   : open_pulls,
+        'open_pull_counts': dict((project, len(pulls)) for project, pulls in open_pulls.iteritems()),
+        'format'       : AGGREGATE_FORMAT,
+    }
+
+def write_aggregate(organisation_name, data, changed=None):
+    """Writes the aggregate of data, recounting only the changed projects
+    when the previous aggregate is there to build on"""
+    path = aggregate_path(organisation_name)
+    previous = read_snapshot(path) if changed is not None and os.path.exists(path) else None
+    aggregate = compute_aggregate(data, previous, changed)
+    with PersistentDict(path, 'n', format='json') as d:
+        d.update(aggregate)
+    # the web workers serve from the snapshot, the counters are only needed
+    # for the next incremental update
+    serving = dict((key, value) for key, value in aggregate.iteritems() if key != 'counters')
+    snapshot.write(snapshot_path(organisation_name), serving, SNAPSHOT_SPLIT)
+
+class NoData(Exception):
+    """ There is no snapshot of the organisation to serve yet, see refresh.py """
+
+def stale_snapshot(organisation):
+    """Whether the store has a snapshot to match: one that is there, no
+    older than the store and written by this version"""
+    path = snapshot_path(organisation)
+    if not os.path.exists(store_path(organisation)):
+        return False
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(store_path(organisation)):
+        return True
+    return read_snapshot(path, load=Snapshot).get('format') != AGGREGATE_FORMAT
+
+def aggregate_data(organisation):
+    """The aggregate, served from the memory-mapped snapshot. A new snapshot
+    is mapped as soon as a refresh replaces the file.
+
+    Only refresh.py fetches from github and writes snapshots (rebuilding a
+    stale one from the store, see refresh.rebuild), the web workers just map
+    the last one it published."""
+    path = snapshot_path(organisation)
+    if not os.path.exists(path):
+        raise NoData(organisation)
+    data = read_snapshot(path, load=Snapshot)
+    if data.get('format') != AGGREGATE_FORMAT:
+        # written by an older version, the refresher is rebuilding it
+        raise NoData(organisation)
+    return data
+
+def data_version(organisation):
+    """The versions of the store and snapshot files, which change with
+    every refresh"""
+    return store_version(store_path(organisation)), store_version(snapshot_path(organisation))
+
+def map_user_avatars(organisation):
+    return aggregate_data(organisation)['user_avatars']
+
+def aggregate_stats(organisation):
+    """Views over the per project and per user stats, decoding a project's
+    (or user's) record from the snapshot only when it is looked up"""
+    data = aggregate_data(organisation)
+    return DotDictView(data['projects']), DotDictView(data['users'])
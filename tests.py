@@ -1,6 +1,96 @@
-from testify import TestCase, assert_equals, suite, class_setup
-from store import count_per_user, load_data, map_user_avatars, aggregate_data, aggregate_stats
-from github import pull_requests, pull_requests_with_comments, organisation_repositories, organisation
+import os
+import gzip
+import shutil
+import subprocess
+import tempfile
+import time
+from cStringIO import StringIO
+from datetime import date
+from operator import itemgetter
+from multiprocessing.pool import ThreadPool
+import omnijson as json
+from testify import TestCase, assert_equals, assert_not_equal, suite, class_setup, setup, teardown
+from mock import patch, Mock
+import config
+from store import count_per_user, count_all, open_pull_requests, window_days, windowed_totals, windowed_user_stats, windowed_project_stats, load_data, map_user_avatars, aggregate_data, aggregate_stats, store_path, aggregate_path
+import github
+from dictionaries import DotDict, DotDictView
+from counter import Counter
+import store
+import snapshot
+import refresh
+import fakehub
+from fakehub import FakeGitHub
+import metrics
+from httpcache import ResponseCache
+from github import pull_requests, pull_requests_with_comments, organisation_repositories, organisation, github_api, api_report
+
+def pull(number, login, project, state='closed', updated_at='2013-01-01T00:00:00Z'):
+    return {
+        'id': hash((project, number)),
+        'number': number,
+        'state': state,
+        'created_at': '2013-01-01T00:00:00Z',
+        'updated_at': updated_at,
+        'title': 'pull %d' % number,
+        'body': 'fixes #%d' % number,
+        'html_url': 'https://github.com/yola/%s/pull/%d' % (project, number),
+        'user': {'login': login, 'avatar_url': 'https://avatars/%s' % login},
+        'base': {'repo': {'name': project}},
+    }
+
+def comment(id, login, project, number, updated_at='2013-01-01T00:00:00Z'):
+    return {
+        'id': id,
+        'body': 'lgtm',
+        'created_at': updated_at,
+        'updated_at': updated_at,
+        'pull_request_url': 'https://api.github.com/repos/yola/%s/pulls/%d' % (project, number),
+        'user': {'login': login, 'avatar_url': 'https://avatars/%s' % login},
+    }
+
+def sample_store():
+    pulls = {
+        'supporttools': [pull(1, 'michaeljoseph', 'supporttools'), pull(2, 'dochead', 'supporttools', state='open')],
+        'yolacom': [pull(1, 'michaeljoseph', 'yolacom')],
+    }
+    comments = {
+        'supporttools': [comment(10, 'dochead', 'supporttools', 1), comment(11, 'dochead', 'supporttools', 2)],
+        'yolacom': [comment(12, 'musamhlengi', 'yolacom', 1)],
+    }
+    return {
+        'pull_requests'                    : pulls['supporttools'] + pulls['yolacom'],
+        'pull_requests_per_project'        : pulls,
+        'pull_request_comments'            : comments['supporttools'] + comments['yolacom'],
+        'pull_request_comments_per_project': comments,
+        'projects'                         : ['supporttools', 'yolacom', 'empty'],
+        'projects_with_pulls'              : ['supporttools', 'yolacom'],
+        'organisation'                     : {'name': 'yola'},
+        'user_data'                        : {'michaeljoseph': {'name': 'Michael'}, 'dochead': {'name': 'Doc'}},
+        'project_data'                     : {'supporttools': {'name': 'supporttools'}, 'yolacom': {'name': 'yolacom'}},
+    }
+
+
+class StoreTestCase(TestCase):
+    """Offline tests against a temporary store seeded with sample_store()"""
+    @setup
+    def create_store(self):
+        self.store = tempfile.mkdtemp()
+        self.config_patch = patch.multiple(config, STORE=self.store, ORGANISATION_NAME='yola', PAGE_CACHE_WARM=False,
+            SNAPSHOT_POLL_INTERVAL=0)
+        self.config_patch.start()
+        self.write_store(sample_store())
+        refresh.rebuild('yola')
+
+    @teardown
+    def remove_store(self):
+        self.config_patch.stop()
+        shutil.rmtree(self.store)
+
+    def write_store(self, data):
+        with open(store_path('yola'), 'w') as f:
+            f.write(json.dumps(data))
+
 
 class GitHubTestCase(TestCase):
 
@@ -35,6 +125,132 @@ class GitHubTestCase(TestCase):
         assert_equals(len(org.keys()), 23)
 
 
+class ExtractTestCase(TestCase):
+
+    @suite('extract')
+    def test_extract_nested_fields(self):
+        fields = ['number', ['base', 'repo', 'name'], {'user': ['login']}, {'head': [{'repo': ['name']}]}]
+        pull_request = {'number': 1, 'title': 'x', 'base': {'repo': {'name': 'supporttools', 'forks': 3}},
+            'head': {'repo': {'name': 'fork', 'forks': 0}}, 'user': None}
+
+        assert_equals(github.extract(pull_request, fields),
+            {'number': 1, 'repo': 'supporttools', 'user': None, 'head': {'repo': {'name': 'fork'}}})
+        assert_equals(github.extract(pull_request, fields), github.extract(pull_request, fields))
+
+    @suite('extract')
+    def test_fields_projected_at_ingest(self):
+        data = sample_store()
+        data['pull_requests_per_project']['supporttools'][0]['head'] = {'repo': {'name': 'supporttools'}}
+        with patch('github.github_api', FakeGitHub(data)), patch.object(config, 'STORE', tempfile.mkdtemp()) as store:
+            stored = load_data('yola', update=True)
+            shutil.rmtree(store)
+
+        pull_request = stored['pull_requests_per_project']['supporttools'][0]
+        assert 'head' not in pull_request
+        assert_equals(pull_request['base'], {'repo': {'name': 'supporttools'}})
+        assert_equals(stored['project_data']['supporttools'], {'name': 'supporttools'})
+
+
+class GitHubApiTestCase(StoreTestCase):
+    @setup
+    def reset_report(self):
+        github.reset_api_report()
+        github._rate_limit.clear()
+
+    @teardown
+    def forget_rate_limit(self):
+        # or the next api call really waits for the reset
+        github._rate_limit.clear()
+        github.reset_api_report()
+
+    def response(self, status=200, remaining=4000, content='[]', **headers):
+        headers.update({
+            'X-RateLimit-Remaining': str(remaining),
+            'X-RateLimit-Reset': str(int(time.time()) + 30)})
+        return Mock(ok=status < 400, status_code=status, content=content, headers=headers, url='https://api.github.com/orgs/yola')
+
+    @suite('api')
+    def test_waits_for_rate_limit_reset(self):
+        with patch.object(github, 'session') as session, patch('time.sleep') as sleep:
+            session.get.return_value = self.response(remaining=1)
+            github_api('/orgs/yola')
+            github_api('/orgs/yola')
+
+        assert_equals(sleep.call_count, 1)
+        assert 29 <= sleep.call_args[0][0] <= 31
+        assert_equals(api_report()['throttled'], 1)
+
+    @suite('api')
+    def test_retries_exhausted_rate_limit(self):
+        with patch.object(github, 'session') as session, patch('time.sleep'):
+            session.get.side_effect = [self.response(status=403, remaining=0), self.response()]
+            assert github_api('/orgs/yola').ok
+
+        assert_equals(api_report()['failures'], [])
+
+    @suite('api')
+    def test_reports_failed_requests(self):
+        with patch.object(github, 'session') as session:
+            session.get.return_value = self.response(status=502)
+            assert not github_api('/orgs/yola').ok
+
+        assert_equals(api_report()['failures'], [('/orgs/yola', 502)])
+
+    @suite('api')
+    def test_credentials_only_sent_to_api_host(self):
+        credentials = (config.GITHUB_USER, config.GITHUB_PASSWORD)
+        assert_equals(github.api_auth('https://api.github.com/orgs/yola/repos?page=2'), credentials)
+        assert_equals(github.api_auth('https://elsewhere.example.com/orgs/yola'), None)
+        assert_equals(github.api_auth('http://api.github.com/orgs/yola'), None)
+        with patch.object(config, 'GITHUB_API_URL', 'http://localhost:8001'):
+            assert_equals(github.api_auth('http://localhost:8001/orgs/yola'), credentials)
+        with patch.object(config, 'GITHUB_API_URL', 'http://github.example.com'):
+            assert_equals(github.api_auth('http://github.example.com/orgs/yola'), None)
+
+    @suite('api-cache')
+    def test_one_response_cache_across_threads(self):
+        def slow_cache(*args):
+            time.sleep(0.01)
+            return ResponseCache(*args)
+        with patch.object(github, '_response_cache', None), patch('github.ResponseCache', side_effect=slow_cache) as made:
+            caches = ThreadPool(8).map(lambda _: github.response_cache(), range(8))
+            assert_equals(made.call_count, 1)
+        assert_equals(len(set(map(id, caches))), 1)
+
+    @suite('api')
+    def test_retries_over_http_too(self):
+        session = github.api_session()
+        adapter = session.get_adapter('https://api.github.com/orgs/yola')
+        assert_equals(adapter.max_retries.total, config.GITHUB_RETRIES)
+        assert session.get_adapter('http://localhost:8001/orgs/yola') is adapter
+
+    @suite('api-cache')
+    def test_not_modified_served_from_cache(self):
+        with patch.object(github, 'session') as session:
+            session.get.side_effect = [
+                self.response(content='[{"id": 1}]', ETag='"abc"', Link='<https://api.github.com/orgs/yola/repos?page=2>; rel="next"'),
+                self.response(status=304)]
+            github_api('/orgs/yola/repos')
+            response = github_api('/orgs/yola/repos')
+
+        assert_equals(session.get.call_args[1]['headers'], {'If-None-Match': '"abc"'})
+        assert_equals((response.status_code, json.loads(response.content)), (200, [{'id': 1}]))
+        assert_equals(response.links['next']['url'], 'https://api.github.com/orgs/yola/repos?page=2')
+        assert_equals((api_report()['cache_hits'], api_report()['cache_misses']), (1, 1))
+
+    @suite('api-cache')
+    def test_evicts_least_recently_used(self):
+        cache = ResponseCache(os.path.join(self.store, 'evict'), max_bytes=300)
+        for page in range(3):
+            cache.put('/orgs/yola/repos', {'page': page}, self.response(content='x' * 100, ETag=str(page)))
+            os.utime(cache.path('/orgs/yola/repos', {'page': page}), (page, page))
+        cache.put('/orgs/yola/repos', {'page': 3}, self.response(content='x' * 100, ETag='3'))
+
+        assert cache.size <= 300
+        assert_equals(cache.get('/orgs/yola/repos', {'page': 0}), None)
+        assert_equals(cache.get('/orgs/yola/repos', {'page': 3})['etag'], '3')
+
+
 class AggregationTestCase(TestCase):
 
     @suite('count')
@@ -48,6 +264,66 @@ class AggregationTestCase(TestCase):
         expected = [{'count': 2, 'login': u'dochead'}, {'count': 1, 'login': u'musamhlengi'}]
         assert_equals(count_per_user(raw_data, 'username'), expected)
 
+    @suite('count')
+    def test_count_all(self):
+        data = sample_store()
+        data['pull_requests_per_project']['yolacom'].append(pull(2, 'mr.dot', 'yolacom'))
+        counts = count_all(data)
+
+        assert_equals(sorted(counts['projects']['supporttools']['pulls'], key=itemgetter('login')),
+            [{'login': 'dochead', 'count': 1}, {'login': 'michaeljoseph', 'count': 1}])
+        assert_equals(counts['projects']['supporttools']['dochead'], {'pulls': 1, 'comments': 2})
+        assert_equals(counts['users']['mr.dot'], {'yolacom': {'pulls': 1}})
+        assert_equals(counts['users']['michaeljoseph'], {'supporttools': {'pulls': 1}, 'yolacom': {'pulls': 1}})
+        assert_equals(counts['totals']['comments'], [{'login': 'dochead', 'count': 2}, {'login': 'musamhlengi', 'count': 1}])
+        assert_equals(counts['avatars']['mr.dot'], 'https://avatars/mr.dot')
+
+    @suite('count')
+    def test_merge_counters(self):
+        merged = Counter.merge([Counter({'dochead': 2}), {'dochead': 1, 'mr.dot': 3}, Counter()])
+        assert_equals(merged, Counter({'dochead': 3, 'mr.dot': 3}))
+        assert_equals(Counter.merge([]), Counter())
+        assert_equals(Counter({'dochead': 2}) + Counter({'mr.dot': 1}), Counter({'dochead': 2, 'mr.dot': 1}))
+
+
+class SyntheticOrgTestCase(TestCase):
+
+    @suite('benchmark')
+    def test_seeded_and_store_shaped(self):
+        from benchmark import synthetic_org
+        data = synthetic_org(repos=5, pulls=10, comments=2, users=8, seed=3)
+        assert_equals(data, synthetic_org(repos=5, pulls=10, comments=2, users=8, seed=3))
+        assert_not_equal(data, synthetic_org(repos=5, pulls=10, comments=2, users=8, seed=4))
+        assert_equals(len(data['pull_requests']), sum(len(pulls) for pulls in data['pull_requests_per_project'].values()))
+        assert len(set(item['id'] for item in data['pull_requests'])) == len(data['pull_requests'])
+        counts = count_all(data)
+        assert_equals(sum(item['count'] for item in counts['totals']['pulls']), len(data['pull_requests']))
+
+
+class DotDictViewTestCase(TestCase):
+    @setup
+    def create_dicts(self):
+        self.data = {'supporttools': {'dochead': {'pulls': 1}, 'pulls': [{'login': 'dochead', 'count': 1}]}}
+        self.view = DotDictView(self.data)
+
+    @suite('dotdict')
+    def test_reads_match_dotdict(self):
+        dotdict = DotDict(self.data)
+        for key in ['supporttools', 'supporttools.dochead.pulls', 'supporttools.pulls.login', 'missing']:
+            assert_equals(self.view[key], dotdict[key])
+        assert_equals(self.view.supporttools.dochead, dotdict.supporttools.dochead)
+        assert_equals(sorted(self.view.get_keys()), sorted(dotdict.get_keys()))
+
+    @suite('dotdict')
+    def test_nested_reads_are_not_copies(self):
+        assert self.view['supporttools.dochead']._dict is self.data['supporttools']['dochead']
+        assert DotDict(self.data, view=True).supporttools._dict is self.data['supporttools']
+        assert self.view.get_keys() is self.view.get_keys()
+        with patch('dictionaries.DotDict.__init__') as copied:
+            keys = self.view.get_keys('supporttools')
+            assert not copied.called
+        assert_equals(sorted(keys), sorted(DotDict(self.data).get_keys('supporttools')))
+
 
 class PersistenceTestCase(TestCase):
     @class_setup
@@ -74,7 +350,9 @@ class PersistenceTestCase(TestCase):
     @suite('aggregate')
     def test_aggregate_data(self):
         data = aggregate_data(self.organisation)
-        assert_equals(sorted(data.keys()), sorted(['raw', 'user_avatars', 'projects', 'users', 'totals']))
+        assert_equals(sorted(data.keys()), sorted(['user_avatars', 'projects', 'users', 'totals',
+            'organisation', 'project_names', 'user_data', 'project_data', 'timeline', 'months', 'open_pulls',
+            'open_pull_counts', 'format']))
 
     @suite('aggregate-stats')
     def test_pull_and_comment_stats(self):
@@ -93,6 +371,744 @@ class PersistenceTestCase(TestCase):
         data = load_data('github')
         assert data
 
+
+class SnapshotCacheTestCase(StoreTestCase):
+
+    @suite('snapshot')
+    def test_parses_store_once(self):
+        data = load_data('yola')
+        assert_equals(data['projects'], ['supporttools', 'yolacom', 'empty'])
+        assert load_data('yola') is data
+
+    @suite('snapshot')
+    def test_reparses_changed_store(self):
+        data = load_data('yola')
+        self.write_store({'projects': ['supporttools', 'yolacom']})
+        os.utime(store_path('yola'), (0, 0))
+
+        reloaded = load_data('yola')
+        assert_not_equal(reloaded, data)
+        assert_equals(reloaded['projects'], ['supporttools', 'yolacom'])
+
+
+class TimeWindowTestCase(StoreTestCase):
+
+    @suite('window')
+    def test_window_days(self):
+        assert_equals(window_days(days=3, today=date(2013, 3, 1)), ['2013-03-01', '2013-02-28', '2013-02-27'])
+        assert_equals(len(window_days(month='2012-02')), 29)
+
+    @suite('window')
+    def test_windowed_leaderboards(self):
+        data = aggregate_data('yola')
+        january = window_days(month='2013-01')
+
+        assert_equals(windowed_totals(data, january)['pulls'], data['totals']['pulls'])
+        assert_equals(windowed_totals(data, january, n=1)['pulls'], [{'login': 'michaeljoseph', 'count': 2}])
+        assert_equals(windowed_totals(data, window_days(days=30, today=date(2013, 3, 1))), {'pulls': [], 'comments': []})
+        assert_equals(windowed_user_stats(data, 'dochead', january), {'supporttools': {'pulls': 1, 'comments': 2}})
+        assert_equals(windowed_project_stats(data, 'yolacom', january), {'michaeljoseph': {'pulls': 1}, 'musamhlengi': {'comments': 1}})
+
+    @suite('window')
+    def test_windowed_routes(self):
+        from app import app
+        client = app.test_client()
+        for url in ['/?days=7', '/?month=2013-01', '/user/dochead?days=30', '/projects/supporttools?month=2013-01']:
+            assert_equals(client.get(url).status_code, 200)
+        for url in ['/?days=0', '/?days=week', '/?month=2013-13']:
+            assert_equals(client.get(url).status_code, 400)
+
+
+class ConcurrentFetchTestCase(StoreTestCase):
+
+    def fetch(self, concurrency):
+        with patch('github.github_api', FakeGitHub(sample_store())):
+            with patch.object(config, 'GITHUB_CONCURRENCY', concurrency):
+                return load_data('yola', update=True)
+
+    @suite('concurrency')
+    def test_concurrent_fetch_matches_sequential(self):
+        sequential = self.fetch(1)
+        assert_equals(sequential['pull_requests_per_project']['supporttools'][0]['number'], 1)
+        assert_equals(len(sequential['pull_request_comments']), 3)
+        assert_equals(self.fetch(8), sequential)
+
+
+class IncrementalSyncTestCase(StoreTestCase):
+
+    @suite('incremental')
+    def test_merges_updated_pulls(self):
+        data = sample_store()
+        data['pull_requests_per_project']['supporttools'][0]['updated_at'] = '2012-12-01T00:00:00Z'
+        with patch('github.github_api', FakeGitHub(data)):
+            load_data('yola', update=True)
+
+        data['pull_requests_per_project']['supporttools'][1] = pull(2, 'dochead', 'supporttools', updated_at='2013-02-01T00:00:00Z')
+        data['pull_requests_per_project']['yolacom'].append(pull(2, 'musamhlengi', 'yolacom', state='open', updated_at='2013-02-02T00:00:00Z'))
+        data['pull_request_comments_per_project']['supporttools'].append(comment(13, 'michaeljoseph', 'supporttools', 2, updated_at='2013-02-01T00:00:00Z'))
+
+        fake = FakeGitHub(data)
+        with patch('github.github_api', fake):
+            updated = load_data('yola', update=True, incremental=True)
+
+        assert_equals([(item['number'], item['state']) for item in updated['pull_requests_per_project']['supporttools']], [(1, 'closed'), (2, 'closed')])
+        assert_equals([item['number'] for item in updated['pull_requests_per_project']['yolacom']], [1, 2])
+        assert_equals([item['id'] for item in updated['pull_request_comments_per_project']['supporttools']], [10, 11, 13])
+        assert_equals(updated['sync_state']['yolacom'], '2013-02-02T00:00:00Z')
+        assert '/repos/yola/supporttools/pulls/1/comments' not in fake.paths
+        assert_equals(aggregate_data('yola')['users']['musamhlengi']['yolacom']['pulls'], 1)
+
+    @suite('incremental')
+    def test_recounts_only_changed_projects(self):
+        data = sample_store()
+        for item in data['pull_requests_per_project']['supporttools'] + data['pull_request_comments_per_project']['supporttools']:
+            item['updated_at'] = '2012-12-01T00:00:00Z'
+        with patch('github.github_api', FakeGitHub(data)):
+            load_data('yola', update=True)
+
+        data['pull_requests_per_project']['yolacom'].append(pull(2, 'michaeljoseph', 'yolacom', updated_at='2013-02-02T00:00:00Z'))
+        with patch('github.github_api', FakeGitHub(data)), patch('store.count_project', wraps=store.count_project) as count_project:
+            updated = load_data('yola', update=True, incremental=True)
+        assert_equals(count_project.call_count, 1)
+
+        aggregate = aggregate_data('yola')
+        recounted = count_all(updated)
+        for key in ['projects', 'users', 'avatars', 'timeline', 'months']:
+            assert_equals(aggregate[key if key != 'avatars' else 'user_avatars'], recounted[key])
+        for kind in ['pulls', 'comments']:
+            assert_equals(sorted(aggregate['totals'][kind]), sorted(recounted['totals'][kind]))
+        assert_equals(aggregate['users']['michaeljoseph']['yolacom'], {'pulls': 2})
+
+
+class FakeHubTestCase(StoreTestCase):
+
+    @setup
+    def start_fakehub(self):
+        self.hub = fakehub.FakeHub(sample_store(), rate_limit=100)
+        self.server = fakehub.start(self.hub)
+        self.api_patch = patch.multiple(config, GITHUB_API_URL=self.server.url, GITHUB_PER_PAGE=1)
+        self.api_patch.start()
+
+    @teardown
+    def stop_fakehub(self):
+        self.api_patch.stop()
+        self.server.shutdown()
+        self.server.server_close()
+        github._rate_limit.clear()
+
+    @suite('fakehub')
+    def test_ingest_over_http(self):
+        data = load_data('yola', update=True)
+        for project, pulls in sample_store()['pull_requests_per_project'].items():
+            assert_equals(sorted(item['number'] for item in data['pull_requests_per_project'][project]), sorted(item['number'] for item in pulls))
+        assert_equals(len(data['pull_request_comments']), 3)
+        # the remaining count of whichever response came back last
+        assert 100 - self.hub.requests <= api_report()['rate_limit_remaining'] < 100
+
+    @suite('fakehub')
+    def test_pagination_and_rate_limit(self):
+        response = github.session.get(self.server.url + '/repos/yola/supporttools/pulls', params={'state': 'all', 'per_page': 1})
+        assert_equals(len(json.loads(response.content)), 1)
+        assert response.links['next']['url'].endswith('/repos/yola/supporttools/pulls?page=2&per_page=1&state=all')
+        assert_equals(github.session.get(self.server.url + '/users/nobody').status_code, 404)
+
+        self.hub.remaining = 0
+        response = github.session.get(self.server.url + '/orgs/yola')
+        assert_equals(response.status_code, 403)
+        assert_equals(response.headers['X-RateLimit-Remaining'], '0')
+
+
+class CheckpointTestCase(StoreTestCase):
+
+    @suite('checkpoint')
+    def test_resumes_after_crash(self):
+        os.remove(store_path('yola'))
+        fake = FakeGitHub(sample_store())
+        def crash_on_yolacom(path, params=None):
+            if '/yolacom/' in path:
+                raise IOError('connection reset')
+            return fake(path, params)
+
+        with patch.object(config, 'GITHUB_CONCURRENCY', 1), patch('github.github_api', crash_on_yolacom):
+            try:
+                load_data('yola', update=True)
+            except IOError:
+                pass
+        assert os.path.exists(os.path.join(store.checkpoint_path('yola'), 'project-supporttools.json'))
+        assert not os.path.exists(store_path('yola'))
+
+        fake.paths = []
+        with patch.object(config, 'GITHUB_CONCURRENCY', 1), patch('github.github_api', fake):
+            data = load_data('yola', update=True)
+        assert not [path for path in fake.paths if '/supporttools/' in path]
+        assert [path for path in fake.paths if '/yolacom/' in path]
+        for project, pulls in sample_store()['pull_requests_per_project'].items():
+            assert_equals(data['pull_requests_per_project'][project], pulls)
+        assert not os.path.exists(store.checkpoint_path('yola'))
+
+    @suite('checkpoint')
+    def test_failed_pages_fetched_again(self):
+        data = sample_store()
+        fake = FakeGitHub(data)
+        def fail_second_page(path, params=None):
+            if '/supporttools/pulls' in path and 'page=2' in path:
+                github._failures.append((path, 502))
+                return Mock(ok=False, status_code=502, content='', links={})
+            return fake(path, params)
+
+        os.remove(store_path('yola'))
+        with patch.object(config, 'GITHUB_PER_PAGE', 1), patch('github.github_api', fail_second_page):
+            stored = load_data('yola', update=True)
+        # a full fetch missing pages gets no cursor, so is fetched in full again
+        assert 'supporttools' not in stored['sync_state']
+        assert_equals(stored['sync_state']['yolacom'], '2013-01-01T00:00:00Z')
+
+        with patch.object(config, 'GITHUB_PER_PAGE', 1), patch('github.github_api', fake):
+            stored = load_data('yola', update=True, incremental=True)
+        assert_equals(len(stored['pull_requests_per_project']['supporttools']), 2)
+        assert_equals(stored['sync_state']['supporttools'], '2013-01-01T00:00:00Z')
+
+        for number, item in enumerate(data['pull_requests_per_project']['supporttools']):
+            item['updated_at'] = '2013-03-0%dT00:00:00Z' % (number + 1)
+        with patch.object(config, 'GITHUB_PER_PAGE', 1), patch('github.github_api', fail_second_page):
+            stored = load_data('yola', update=True, incremental=True)
+        # an incremental fetch missing pages keeps its last cursor
+        assert_equals(stored['sync_state']['supporttools'], '2013-01-01T00:00:00Z')
+
+        with patch.object(config, 'GITHUB_PER_PAGE', 1), patch('github.github_api', fake):
+            stored = load_data('yola', update=True, incremental=True)
+        assert_equals(sorted(item['updated_at'] for item in stored['pull_requests_per_project']['supporttools']),
+            ['2013-03-01T00:00:00Z', '2013-03-02T00:00:00Z'])
+        assert_equals(stored['sync_state']['supporttools'], '2013-03-02T00:00:00Z')
+
+    @suite('checkpoint')
+    def test_other_runs_checkpoints_ignored(self):
+        directory = store.open_checkpoints('yola', {'incremental': True, 'store': [1, 2, 3]})
+        store.write_checkpoint(directory, 'project-supporttools', {'pulls': [], 'comments': [], 'changed': True})
+        fake = FakeGitHub(sample_store())
+        with patch('github.github_api', fake):
+            data = load_data('yola', update=True)
+        assert_equals(len(data['pull_requests_per_project']['supporttools']), 2)
+
+
+class NormalisedStoreTestCase(StoreTestCase):
+
+    @suite('normalised')
+    def test_records_stored_once(self):
+        with patch('github.github_api', FakeGitHub(sample_store())):
+            data = load_data('yola', update=True)
+
+        with open(store_path('yola')) as f:
+            stored = json.loads(f.read())
+        assert 'pull_requests' not in stored
+        assert_equals(len(stored['pull_request_records']), 3)
+        assert_equals(sorted(stored['pull_request_comment_ids_per_project']['supporttools']), ['10', '11'])
+
+        store._snapshots.clear()
+        reloaded = load_data('yola')
+        assert_equals(reloaded, data)
+        assert reloaded['pull_requests'][0] is reloaded['pull_requests_per_project']['supporttools'][0]
+
+
+class BulkCommentsTestCase(StoreTestCase):
+
+    def fetch(self, bulk):
+        fake = FakeGitHub(sample_store())
+        with patch('github.github_api', fake), patch.object(config, 'GITHUB_BULK_COMMENTS', bulk):
+            return load_data('yola', update=True), fake.paths
+
+    @suite('bulk-comments')
+    def test_bulk_matches_per_pull(self):
+        bulk, bulk_paths = self.fetch(True)
+        per_pull, per_pull_paths = self.fetch(False)
+
+        assert_equals(bulk, per_pull)
+        assert_equals(len([path for path in bulk_paths if path.endswith('/comments')]), 3)
+        assert '/repos/yola/supporttools/pulls/comments' in bulk_paths
+        assert '/repos/yola/supporttools/pulls/2/comments' in per_pull_paths
+
+    @suite('bulk-comments')
+    def test_incremental_merges_comments_by_id(self):
+        data = sample_store()
+        with patch('github.github_api', FakeGitHub(data)):
+            load_data('yola', update=True)
+
+        edited = comment(10, 'dochead', 'supporttools', 1, updated_at='2013-02-01T00:00:00Z')
+        edited['body'] = 'ship it'
+        data['pull_request_comments_per_project']['supporttools'][0] = edited
+        with patch('github.github_api', FakeGitHub(data)), patch.object(config, 'GITHUB_BULK_COMMENTS', True):
+            updated = load_data('yola', update=True, incremental=True)
+
+        comments = updated['pull_request_comments_per_project']['supporttools']
+        assert_equals([(item['id'], item['body']) for item in comments], [(10, 'ship it'), (11, 'lgtm')])
+
+
+class PaginationTestCase(TestCase):
+
+    @suite('pagination')
+    def test_follows_next_links(self):
+        fake = FakeGitHub(sample_store())
+        with patch('github.github_api', fake), patch.object(config, 'GITHUB_PER_PAGE', 1):
+            pulls, comments = pull_requests_with_comments('yola', 'supporttools', state='closed')
+            repos = organisation_repositories('yola')
+
+        assert_equals([pull['number'] for pull in pulls], [1])
+        assert_equals([comment['id'] for comment in comments], [10])
+        assert_equals([repo['name'] for repo in repos], ['supporttools', 'yolacom', 'empty'])
+        assert_equals(len([path for path in fake.paths if path.startswith('/orgs/yola/repos')]), 3)
+
+    @suite('pagination')
+    def test_pages_are_yielded_as_fetched(self):
+        with patch('github.github_api', FakeGitHub(sample_store())), patch.object(config, 'GITHUB_PER_PAGE', 2):
+            pages = list(github.iter_organisation_repositories('yola'))
+
+        assert_equals([len(page) for page in pages], [2, 1])
+
+
+class PrecomputedAggregateTestCase(StoreTestCase):
+
+    @suite('precomputed')
+    def test_aggregate_written_from_store(self):
+        data = aggregate_data('yola')
+        assert os.path.exists(aggregate_path('yola'))
+        assert_equals(data['totals']['pulls'], [{'login': 'michaeljoseph', 'count': 2}, {'login': 'dochead', 'count': 1}])
+        assert_equals(data['users']['dochead']['supporttools'], {'pulls': 1, 'comments': 2})
+        assert_equals(data['user_avatars']['musamhlengi'], 'https://avatars/musamhlengi')
+        assert aggregate_data('yola') is data
+
+    @suite('precomputed')
+    def test_routes_read_only_the_aggregate(self):
+        aggregate_data('yola')
+        with patch('store.load_data') as load_data:
+            from app import app
+            client = app.test_client()
+            for url in ['/', '/user/dochead', '/projects/supporttools']:
+                assert_equals(client.get(url).status_code, 200)
+            assert not load_data.called
+
+
+class PageCacheTestCase(StoreTestCase):
+
+    @setup
+    def clear_pages(self):
+        import app
+        self.app = app
+        app.pages.clear()
+        self.client = app.app.test_client()
+
+    @suite('pages')
+    def test_conditional_responses(self):
+        response = self.client.get('/user/dochead')
+        etag, last_modified = response.headers['ETag'], response.headers['Last-Modified']
+        assert_equals(self.client.get('/user/dochead', headers={'If-None-Match': etag}).status_code, 304)
+        assert_equals(self.client.get('/user/dochead', headers={'If-Modified-Since': last_modified}).status_code, 304)
+
+        with patch('github.github_api', FakeGitHub(sample_store())):
+            load_data('yola', update=True)
+        response = self.client.get('/user/dochead', headers={'If-None-Match': etag})
+        assert_equals(response.status_code, 200)
+        assert_not_equal(response.headers['ETag'], etag)
+
+    @suite('pages')
+    def test_rendered_once_per_version(self):
+        with patch('app.render_template', wraps=self.app.render_template) as render_template:
+            first = self.client.get('/projects/supporttools').data
+            assert_equals(self.client.get('/projects/supporttools').data, first)
+            assert_equals(render_template.call_count, 1)
+            self.client.get('/projects/supporttools?month=2013-01')
+            assert_equals(render_template.call_count, 2)
+
+    @suite('pages')
+    def test_keyed_on_the_args_read(self):
+        with patch('app.render_template', wraps=self.app.render_template) as render_template:
+            for url in ['/?days=30', '/?x=1&days=30', '/?days=030&utm=y']:
+                assert_equals(self.client.get(url).status_code, 200)
+            assert_equals(render_template.call_count, 1)
+        assert_equals(len(self.app.pages), 1)
+
+        etag = self.client.get('/').headers['ETag'].strip('"')
+        assert_equals(self.client.get('/', headers={'If-None-Match': etag}).status_code, 304)
+        assert_equals(self.client.get('/?days=abc', headers={'If-None-Match': etag}).status_code, 400)
+        assert_equals(self.client.get('/open-pull-requests?page=9', headers={'If-None-Match': etag}).status_code, 404)
+
+    @suite('pages')
+    def test_warm_pages(self):
+        self.app.warm_pages()
+        assert_equals(len(self.app.pages), 2 + 3 + 3 + 3)
+        with patch('app.render_template') as render_template:
+            for url in ['/', '/open-pull-requests', '/user/musamhlengi', '/projects/empty']:
+                assert_equals(self.client.get(url).status_code, 200)
+            assert not render_template.called
+
+    @suite('pages')
+    def test_warm_pages_within_capacity(self):
+        self.app.pages.max_size = 4
+        try:
+            self.app.warm_pages()
+            assert_equals(self.app.pages.keys(), [
+                ('index', (), ()), ('open_pulls', (), ((), 1)), ('api_open_pulls', (), (0, 100, None)),
+                ('api_leaderboard', (('kind', 'pulls'),), (0, 100, None))])
+        finally:
+            self.app.pages.max_size = config.PAGE_CACHE_SIZE
+
+    @suite('pages')
+    def test_bodies_rendered_once_per_update(self):
+        self.app.bodies.clear()
+        item = pull(3, 'dochead', 'supporttools', state='open')
+        item['body'] = '**bold** <script>'
+        with patch.object(self.app.markdown, '_instance', wraps=self.app.markdown._instance) as instance:
+            html = self.app.rendered_body(item)
+            assert_equals(html, '<p><strong>bold</strong> &lt;script&gt;</p>')
+            self.app.rendered_body(item)
+            assert_equals(instance.convert.call_count, 1)
+            item['updated_at'] = '2013-03-01T00:00:00Z'
+            self.app.rendered_body(item)
+            assert_equals(instance.convert.call_count, 2)
+        assert 'fixes #2' in self.client.get('/open-pull-requests').data
+        assert_equals(len(self.app.bodies), 3)
+
+    @suite('pages')
+    def test_open_pulls_streamed_then_cached(self):
+        data = sample_store()
+        supporttools = data['pull_requests_per_project']['supporttools'] = [
+            pull(number, 'dochead', 'supporttools', state='open') for number in (1, 2, 3)]
+        for item in supporttools:
+            item['created_at'] = '2013-01-0%dT00:00:00Z' % item['number']
+        data['pull_requests_per_project']['yolacom'].append(pull(4, 'michaeljoseph', 'yolacom', state='open'))
+        data['pull_requests'] = sum(data['pull_requests_per_project'].values(), [])
+        self.write_store(data)
+        refresh.rebuild('yola')
+
+        with patch('config.OPEN_PULLS_PAGE_SIZE', 2):
+            with patch('app.stream_template', wraps=self.app.stream_template) as stream_template:
+                first = self.client.get('/open-pull-requests?project=supporttools').data
+                assert 'pull 3' in first and 'pull 2' in first and 'pull 1' not in first
+                assert 'Page 1 of 2 (3 open)' in first
+
+                url = '/open-pull-requests?page=2&project=supporttools'
+                response = self.client.get(url)
+                page = response.data
+                assert 'pull 1' in page and 'pull 2' not in page and 'pull 4' not in page
+                assert 'Page 2 of 2 (3 open)' in page
+                assert 'page=1' in page and 'page=3' not in page
+                assert 'href="/open-pull-requests?project=yolacom">yolacom (1)</a>' in page
+                assert 'href="/open-pull-requests?project=supporttools">supporttools (3)</a>' in page
+                assert_equals(stream_template.call_count, 2)
+
+                # the second request is served whole, from the page cache
+                key = ('open_pulls', (), (('supporttools',), 2))
+                assert_equals(self.app.pages[key][1], page.decode('utf-8'))
+                assert_equals(self.client.get(url).data, page)
+                assert_equals(stream_template.call_count, 2)
+
+            assert 'Page 1 of 2 (3 open)' in self.client.get('/open-pull-requests?project=supporttools&project=supporttools').data
+            assert 'Page 1 of 2 (4 open)' in self.client.get('/open-pull-requests').data
+            assert_equals(self.client.get('/open-pull-requests?page=3').status_code, 404)
+            assert_equals(self.client.get('/open-pull-requests?page=x').status_code, 400)
+
+
+class ApiTestCase(StoreTestCase):
+
+    @setup
+    def clear_pages(self):
+        import app
+        self.app = app
+        app.pages.clear()
+        self.client = app.app.test_client()
+
+    def get_json(self, url, **kwargs):
+        response = self.client.get(url, **kwargs)
+        assert_equals(response.status_code, 200)
+        assert_equals(response.mimetype, 'application/json')
+        return json.loads(response.data)
+
+    @suite('api')
+    def test_leaderboard_pages(self):
+        first = self.get_json('/api/leaderboards/comments?limit=1')
+        assert_equals(first['items'], [{'login': 'dochead', 'count': 2}])
+        assert_equals(first['total'], 2)
+        second = self.get_json('/api/leaderboards/comments?limit=1&cursor=%s' % first['next'])
+        assert_equals(second['items'], [{'login': 'musamhlengi', 'count': 1}])
+        assert_equals(second['next'], None)
+
+        assert_equals(self.client.get('/api/leaderboards/reviews').status_code, 404)
+        assert_equals(self.client.get('/api/leaderboards/pulls?limit=0').status_code, 400)
+        assert_equals(self.client.get('/api/leaderboards/pulls?cursor=nonsense').status_code, 400)
+
+    @suite('api')
+    def test_cursor_expires_with_refresh(self):
+        cursor = self.get_json('/api/leaderboards/pulls?limit=1')['next']
+        with patch('github.github_api', FakeGitHub(sample_store())):
+            load_data('yola', update=True)
+        assert_equals(self.client.get('/api/leaderboards/pulls?limit=1&cursor=%s' % cursor).status_code, 410)
+
+    @suite('api')
+    def test_open_pulls_fields(self):
+        pulls = self.get_json('/api/open-pull-requests?fields=number,user.login,base.repo.name')
+        assert_equals(pulls['items'], [{'number': 2, 'user': {'login': 'dochead'}, 'base': {'repo': {'name': 'supporttools'}}}])
+
+    @suite('api')
+    def test_open_pulls_read_a_page(self):
+        with patch('app.open_pull_requests', wraps=self.app.open_pull_requests) as open_pulls:
+            first = self.get_json('/api/open-pull-requests?project=supporttools&limit=1')
+            open_pulls.assert_called_once_with('yola', ('supporttools',), 0, 1)
+        assert_equals((len(first['items']), first['total'], first['next']), (1, 1, None))
+        cursor = self.app.urlsafe_b64encode('-1:%s' % self.app.data_etag()[:12])
+        assert_equals(self.client.get('/api/open-pull-requests?cursor=%s' % cursor).status_code, 400)
+
+    @suite('api')
+    def test_gzipped_once(self):
+        with patch('app.GZIP_MIN_BYTES', 0):
+            with patch('app.compressed', wraps=self.app.compressed) as compressed:
+                for _ in range(2):
+                    response = self.client.get('/api/open-pull-requests', headers={'Accept-Encoding': 'gzip'})
+                    assert_equals(response.content_encoding, 'gzip')
+                    assert_equals(response.headers['Vary'], 'Accept-Encoding')
+                assert_equals(compressed.call_count, 1)
+            plain = self.client.get('/api/open-pull-requests')
+        assert_equals(plain.content_encoding, None)
+        assert_equals(gzip.GzipFile(fileobj=StringIO(response.data)).read(), plain.data)
+
+        # a cache revalidating either one gets its own encoding back
+        assert_not_equal(response.headers['ETag'], plain.headers['ETag'])
+        not_modified = self.client.get('/api/open-pull-requests',
+            headers={'Accept-Encoding': 'gzip', 'If-None-Match': response.headers['ETag']})
+        assert_equals(not_modified.status_code, 304)
+        assert_equals(not_modified.headers['Vary'], 'Accept-Encoding')
+        assert_equals(self.client.get('/api/open-pull-requests',
+            headers={'If-None-Match': response.headers['ETag']}).status_code, 200)
+
+
+class MappedSnapshotTestCase(StoreTestCase):
+
+    @suite('snapshot')
+    def test_split_sections(self):
+        path = os.path.join(self.store, 'test.snapshot')
+        snapshot.write(path, {'months': ['2013-01'], 'users': {'dochead': {'supporttools': {'pulls': 1}}},
+            'timeline': {'pulls': {'2013-01-01': {'yolacom': {'dochead': 1}}}}}, {'users': 1, 'timeline': 2})
+        with open(path, 'rb') as f:
+            data = snapshot.Snapshot(f)
+        assert_equals(sorted(data.keys()), ['months', 'timeline', 'users'])
+        assert_equals(data['months'], ['2013-01'])
+        assert_equals(data['users']['dochead'], {'supporttools': {'pulls': 1}})
+        assert_equals(data['users'].get('nobody'), None)
+        assert_equals(data['timeline']['pulls'].get('2013-01-01'), {'yolacom': {'dochead': 1}})
+        assert_equals(data['timeline'], {'pulls': {'2013-01-01': {'yolacom': {'dochead': 1}}}})
+
+    @suite('snapshot')
+    def test_switches_after_refresh(self):
+        data = aggregate_data('yola')
+        assert isinstance(data, snapshot.Snapshot)
+        assert_equals(open_pull_requests('yola'), [item for item in sample_store()['pull_requests'] if item['state'] == 'open'])
+
+        refreshed = sample_store()
+        refreshed['pull_requests_per_project']['yolacom'].append(pull(2, 'dochead', 'yolacom'))
+        with patch('github.github_api', FakeGitHub(refreshed)):
+            load_data('yola', update=True)
+        assert_equals(aggregate_data('yola')['users']['dochead']['yolacom'], {'pulls': 1})
+        # the previous mapping stays readable until it's dropped
+        assert_equals(data['users']['dochead'], {'supporttools': {'pulls': 1, 'comments': 2}})
+
+    @suite('store')
+    def test_open_pulls_index(self):
+        data = sample_store()
+        data['pull_requests_per_project']['yolacom'] += [
+            pull(2, 'dochead', 'yolacom', state='open'), pull(3, 'musamhlengi', 'yolacom', state='open')]
+        data['pull_requests_per_project']['yolacom'][-1]['created_at'] = '2013-02-01T00:00:00Z'
+        data['pull_requests'] = sum(data['pull_requests_per_project'].values(), [])
+        with patch('github.github_api', FakeGitHub(data)):
+            load_data('yola', update=True)
+
+        numbers = lambda pulls: [(item['base']['repo']['name'], item['number']) for item in pulls]
+        assert_equals(aggregate_data('yola')['open_pull_counts'], {'supporttools': 1, 'yolacom': 2})
+        assert_equals(numbers(open_pull_requests('yola')), [('supporttools', 2), ('yolacom', 3), ('yolacom', 2)])
+        assert_equals(numbers(open_pull_requests('yola', offset=1, limit=1)), [('yolacom', 3)])
+        assert_equals(numbers(open_pull_requests('yola', offset=2)), [('yolacom', 2)])
+        assert_equals(numbers(open_pull_requests('yola', ['yolacom', 'empty'], limit=1)), [('yolacom', 3)])
+        assert_equals(numbers(open_pull_requests('yola', ['yolacom', 'yolacom'])), [('yolacom', 3), ('yolacom', 2)])
+
+    @suite('snapshot')
+    def test_aggregate_stats_decode_on_lookup(self):
+        aggregate_data('yola')
+        with patch.object(snapshot.Snapshot, 'load', wraps=aggregate_data('yola').load) as load:
+            project_counts, user_counts = aggregate_stats('yola')
+            decoded = load.call_count
+            assert decoded <= 2     # at most the two sections' indexes, no records
+            assert_equals(project_counts.get('supporttools.dochead.comments'), 2)
+            assert_equals(user_counts['michaeljoseph']['yolacom'], {'pulls': 1})
+            assert_equals(load.call_count, decoded + 2)
+
+    @suite('store')
+    def test_older_aggregate_rebuilt(self):
+        aggregate_data('yola')
+        # open_pulls was a list, before the per project index
+        snapshot.write(store.snapshot_path('yola'), {'open_pulls': open_pull_requests('yola')})
+        # the worker leaves it to the refresher
+        with patch('store.write_aggregate') as write_aggregate:
+            try:
+                aggregate_data('yola')
+            except store.NoData:
+                pass
+            else:
+                assert False, 'expected NoData'
+            assert not write_aggregate.called
+        assert refresh.rebuild('yola')
+        assert_equals(aggregate_data('yola')['format'], store.AGGREGATE_FORMAT)
+        assert_equals(len(open_pull_requests('yola')), 1)
+
+
+class RefreshTestCase(StoreTestCase):
+
+    @suite('refresh')
+    def test_one_refresh_at_a_time(self):
+        with patch('github.github_api', FakeGitHub(sample_store())):
+            with store.refresh_lock('yola') as locked:
+                assert locked
+                assert store.refreshing('yola')
+                assert not refresh.refresh('yola')
+            assert not store.refreshing('yola')
+            assert refresh.refresh('yola')
+        assert os.path.exists(store.snapshot_path('yola'))
+        assert refresh.data_age('yola') < 60
+
+    @suite('refresh')
+    def test_serves_last_snapshot_mid_refresh(self):
+        data = aggregate_data('yola')
+        os.utime(store_path('yola'), (time.time() + 10, time.time() + 10))
+        with store.refresh_lock('yola'):
+            with patch('store.write_aggregate') as write_aggregate:
+                assert aggregate_data('yola') is data
+                assert not write_aggregate.called
+
+    @suite('refresh')
+    def test_requests_never_fetch(self):
+        os.remove(store_path('yola'))
+        os.remove(store.snapshot_path('yola'))
+        with patch('store.load_data') as load:
+            try:
+                aggregate_data('yola')
+            except store.NoData:
+                pass
+            else:
+                assert False, 'expected NoData'
+            assert not load.called
+        from app import app
+        assert_equals(app.test_client().get('/').status_code, 503)
+
+    @suite('refresh')
+    def test_workers_never_rebuild(self):
+        # a store without its snapshot: nothing to serve until the refresher rebuilds it
+        os.remove(store.snapshot_path('yola'))
+        with patch('store.load_data') as load, patch('store.write_aggregate') as write_aggregate:
+            try:
+                aggregate_data('yola')
+            except store.NoData:
+                pass
+            else:
+                assert False, 'expected NoData'
+            assert not load.called
+            assert not write_aggregate.called
+        with store.refresh_lock('yola'):
+            assert not refresh.rebuild('yola')
+        assert refresh.rebuild('yola')
+        assert not refresh.rebuild('yola')
+        assert_equals(aggregate_data('yola')['format'], store.AGGREGATE_FORMAT)
+
+    @suite('refresh')
+    def test_workers_skip_fresh_data(self):
+        aggregate_data('yola')
+        with patch('refresh.refresh') as refresh_now, patch('time.sleep', side_effect=KeyboardInterrupt):
+            try:
+                refresh.run('yola')
+            except KeyboardInterrupt:
+                pass
+        assert not refresh_now.called
+
+
+class MetricsTestCase(StoreTestCase):
+
+    @suite('metrics')
+    def test_render(self):
+        histogram = metrics.Histogram('test_seconds', 'Test timings', ['name'], buckets=(0.1, 1))
+        counter = metrics.Counter('test_total', 'Test counts', ['name'])
+        try:
+            histogram.observe(0.05, name='a')
+            histogram.observe(0.5, name='a')
+            counter.inc(name='say "hi"')
+            other = {'test_total': [[['a'], 2]]}
+            text = metrics.render(others=[({'process': 'refresh'}, other)])
+        finally:
+            metrics._metrics.remove(histogram)
+            metrics._metrics.remove(counter)
+
+        assert '# TYPE test_seconds histogram' in text
+        assert 'test_seconds_bucket{name="a",le="0.1"} 1\n' in text
+        assert 'test_seconds_bucket{name="a",le="1"} 2\n' in text
+        assert 'test_seconds_bucket{name="a",le="+Inf"} 2\n' in text
+        assert 'test_seconds_count{name="a"} 2\n' in text
+        assert 'test_total{name="say \\"hi\\""} 1\n' in text
+        assert 'test_total{name="a",process="refresh"} 2\n' in text
+
+    @suite('metrics')
+    def test_merge(self):
+        histogram = metrics.Histogram('test_seconds', 'Test timings', buckets=(1,))
+        counter = metrics.Counter('test_total', 'Test counts')
+        gauge = metrics.Gauge('test_age', 'Test age')
+        try:
+            merged = metrics.merge([
+                {'test_seconds': [[[], [[1, 0], 0.5]]], 'test_total': [[[], 2]], 'test_age': [[[], 10]]},
+                None,
+                {'test_seconds': [[[], [[0, 1], 2.0]]], 'test_total': [[[], 3]], 'test_age': [[[], 20]]}])
+        finally:
+            for metric in (histogram, counter, gauge):
+                metrics._metrics.remove(metric)
+        assert_equals(merged, {'test_seconds': [[[], [[1, 1], 2.5]]], 'test_total': [[[], 5]], 'test_age': [[[], 20]]})
+
+    @suite('metrics')
+    def test_adds_up_workers(self):
+        from app import app, workers_metrics_path
+        client = app.test_client()
+        client.get('/metrics')
+        other_worker = {'inquisition_page_cache_total': [[['hit'], 1000]]}
+        with open(os.path.join(workers_metrics_path(), '1.json'), 'w') as f:
+            f.write(json.dumps(other_worker))
+        text = client.get('/metrics').data
+        counts = [line for line in text.splitlines() if line.startswith('inquisition_page_cache_total{result="hit"}')]
+        assert_equals(len(counts), 1)
+        assert int(counts[0].split()[1]) >= 1000
+
+    @suite('metrics')
+    def test_retires_exited_workers(self):
+        from app import app, workers_metrics_path
+        client = app.test_client()
+        client.get('/metrics')
+        exited = subprocess.Popen(['true'])
+        exited.wait()
+        name = os.path.join(workers_metrics_path(), '%d-1.json' % exited.pid)
+        with open(name, 'w') as f:
+            f.write(json.dumps({'inquisition_page_cache_total': [[['hit'], 1000]], 'inquisition_snapshot_bytes': [[[], 1]]}))
+        for scrape in range(2):
+            text = client.get('/metrics').data
+            hits = [line for line in text.splitlines() if line.startswith('inquisition_page_cache_total{result="hit"}')]
+            assert 1000 <= int(hits[0].split()[1]) < 2000
+        assert not os.path.exists(name)
+        assert_equals(metrics.read_state(os.path.join(workers_metrics_path(), 'retired.json')),
+            {'inquisition_page_cache_total': [[['hit'], 1000]]})
+
+    @suite('metrics')
+    def test_metrics_page(self):
+        with patch('github.github_api', FakeGitHub(sample_store())):
+            refresh.refresh('yola')
+        from app import app
+        client = app.test_client()
+        client.get('/user/dochead')
+        text = client.get('/metrics').data
+        assert 'inquisition_request_seconds_count{endpoint="user",status="200"}' in text
+        assert 'inquisition_snapshot_bytes ' in text
+        assert 'inquisition_aggregate_seconds_count{mode="full",process="refresh"}' in text
+        assert_equals(github.endpoint('https://api.github.com/repos/yola/supporttools/pulls/12/comments?page=2'),
+            '/repos/:owner/:repo/pulls/:number/comments')
+
 #class FrontEndTestCase(TestCase):
     #def setUp(self):
         #self.app = application.test_client()